@@ -1,8 +1,6 @@
 import asyncio
 from kestra import Kestra
 import argparse
-import time
-import re
 
 from creds import (
     azure_tenant_id,
@@ -16,79 +14,25 @@ from creds import (
     azure_subscription_id_exclustions,
     azure_scope_exclusions,
 )
-from functions.confluence import confluence_update_page
-from atlassian import Confluence
-from functions.msgraphapi import GraphAPI
-from msgraph.generated.models.group import Group
-from azure.identity import ClientSecretCredential
-from azure.mgmt.resourcegraph import ResourceGraphClient
-from azure.mgmt.resourcegraph.models import QueryRequest, QueryRequestOptions
-from functions.functions import get_azure_subscriptions
+from functions.instrumentation import instrumentation, stage
+from functions.confluence import ConfluenceClient
+from functions.msgraphapi import GraphAPI, GROUP_ODATA_TYPE
+from functions.cli import (
+    add_common_arguments,
+    add_sharding_arguments,
+    graph_client_options,
+    instrumentation_options,
+)
+from functions.functions import iter_resource_graph
+from functions.scopes import ScopeResolver
+from functions.datasets import RunDatasets
+from functions.snapshots import store_snapshot
+from functions.assignments import AssignmentTable
 
 logger = Kestra.logger()
 from pprint import pprint
 
-credential = ClientSecretCredential(
-    azure_tenant_id, azure_client_id, azure_client_secret
-)
-
-
-def query_resource_graph(query=None, subscriptions=None):
-
-    resource_graph_client = ResourceGraphClient(credential)
-    if query:
-        # Set up the query request
-        request_options = QueryRequestOptions(result_format="objectArray")
-        if not subscriptions:
-            query_request = QueryRequest(query=query, options=request_options)
-        else:
-            query_request = QueryRequest(
-                subscriptions=subscriptions, query=query, options=request_options
-            )
-
-        response = resource_graph_client.resources(query_request)
-        print(response)
-        return response.data
-
-
-def subscription_translate(scope=None, subscription_dict=None):
-    print(scope)
-    regexp = r"(^\/subscriptions\/)([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(.*)"
-    match = re.search(regexp, scope)
-    if match:
-        start = match.group(1)
-        subscription_id = match.group(2)
-        end = match.group(3)
-    else:
-        return scope
-
-    if subscription_id in subscription_dict:
-        subscription = subscription_dict[subscription_id]
-        logger.debug(f"Subscription found in Azure: {subscription}")
-    else:
-        logger.error("Subscription not found in Azure")
-        subscription = subscription_id
-    for exclusion in azure_subscription_id_exclustions:
-        if exclusion == subscription_id:
-            return False
-    for exclusion in azure_subscription_exclusions:
-        if exclusion in subscription.lower():
-            return False
-
-    scope = f"{start}{subscription}{end}"
-    logger.debug("Scope: " + scope)
-    return scope
-
-
-def check_role_exclusions(role):
-    for exclusion in azure_scope_exclusions:
-        if exclusion in role:
-            return False
-    return True
-
-
-async def audit_azure_resources(graph_client=None, confluence=None, args=None):
-    query = """
+ACTIVE_ASSIGNMENTS_QUERY = """
 authorizationresources
 | where type =~ 'microsoft.authorization/roleassignments'
 | extend roleDefinitionId= tolower(tostring(properties.roleDefinitionId))
@@ -102,70 +46,114 @@ authorizationresources
 | project roleDefinitionId,roleName
 ) on roleDefinitionId
 | extend scope = properties.scope
-| project principalId,roleName,roleDefinitionId, scope
+| project id, principalId, roleName, roleDefinitionId, scope
 """
-    # query = "authorizationresources | limit 10"
-
-    resources = query_resource_graph(query)
-    userid_dict = {}
-    subscription_dict = get_azure_subscriptions(credential=credential, dict=True)
-    entraid_users = await graph_client.get_all_users()
-    for user in entraid_users:
-        userid_dict[user.id] = user.display_name
-    ct = []
-
-    for resource in resources:
-        principalId = resource["principalId"]
-        scope = subscription_translate(
-            scope=resource["scope"], subscription_dict=subscription_dict
-        )
-        if scope and check_role_exclusions(resource["roleName"]):
-            if principalId in userid_dict:
-                ct.append(
-                    {
-                        "Benutzer": userid_dict[principalId],
-                        "Rolle": resource["roleName"],
-                        "Scope": scope,
-                    }
-                )
-            else:
-                try:
-                    group_members = await graph_client.get_group_members(principalId)
-                    if group_members:
-                        for group_member in group_members:
-                            ct.append(
-                                {
-                                    "Benutzer": group_member.display_name,
-                                    "Rolle": resource["roleName"],
-                                    "Scope": scope,
-                                }
-                            )
-                except Exception as e:
-                    logger.error("Cannot Resolve UUID")
-                    ct.append(
-                        {
-                            "Benutzer": principalId,
-                            "Rolle": resource["roleName"],
-                            "Scope": scope,
-                        }
-                    )
-    ct = sorted(
-        ct,
-        key=lambda x: (x["Benutzer"], x["Rolle"]),
-        reverse=False,
+# ACTIVE_ASSIGNMENTS_QUERY = "authorizationresources | limit 10"
+
+
+@instrumentation.timed("Load Active Assignments")
+def collect_active_assignments(credential=None, scope_resolver=None):
+    # Rows are translated while later Resource Graph pages are still loading
+    assignment_table = AssignmentTable()
+    for resource in iter_resource_graph(
+        ACTIVE_ASSIGNMENTS_QUERY, credential=credential
+    ):
+        scope = scope_resolver.translate(resource["scope"])
+        if scope and scope_resolver.check_role(resource["roleName"]):
+            assignment_table.add(
+                resource["principalId"],
+                None,
+                resource["roleDefinitionId"],
+                resource["roleName"],
+                resource["scope"],
+                scope,
+            )
+    return assignment_table
+
+
+async def audit_azure_resources(
+    graph_client=None, confluence=None, args=None, datasets=None
+):
+    if datasets is None:
+        datasets = RunDatasets(graph_client=graph_client)
+
+    subscription_dict = await datasets.azure_subscriptions()
+    scope_resolver = ScopeResolver(
+        subscription_dict=subscription_dict,
+        subscription_id_exclusions=azure_subscription_id_exclustions,
+        subscription_exclusions=azure_subscription_exclusions,
+        role_exclusions=azure_scope_exclusions,
     )
 
+    # Resource Graph paging is blocking, keep the event loop free for Graph
+    direct_assignments, userid_dict = await asyncio.gather(
+        asyncio.to_thread(
+            collect_active_assignments,
+            credential=datasets.credential,
+            scope_resolver=scope_resolver,
+        ),
+        datasets.user_display_names(),
+    )
+    assignment_table = AssignmentTable()
+
+    # Learn the type of every unknown principal in a handful of calls and
+    # only expand the ones that actually are groups
+    principals = await graph_client.resolve_directory_objects(
+        assignment.principal_id
+        for assignment in direct_assignments
+        if assignment.principal_id not in userid_dict
+    )
+    group_ids = [
+        principalId
+        for principalId, principal in principals.items()
+        if principal and principal.odata_type == GROUP_ODATA_TYPE
+    ]
+    members_by_group = await graph_client.get_members_of_groups(
+        group_ids, return_exceptions=True
+    )
+
+    for assignment in direct_assignments:
+        principalId = assignment.principal_id
+        principal = principals.get(principalId)
+        if principalId in userid_dict:
+            users = [(principalId, userid_dict[principalId])]
+        elif principal is None:
+            # Deleted principals keep their raw ID in the table
+            logger.debug(f"Principal {principalId} no longer exists")
+            users = [(principalId, principalId)]
+        elif principal.odata_type != GROUP_ODATA_TYPE:
+            users = [(principalId, principal.display_name)]
+        elif isinstance(members_by_group[principalId], Exception):
+            logger.error("Cannot Resolve UUID")
+            users = [(principalId, principalId)]
+        else:
+            users = [
+                (group_member.id, group_member.display_name)
+                for group_member in members_by_group[principalId]
+            ]
+        for user_id, user in users:
+            assignment_table.add(
+                user_id,
+                user,
+                assignment.role_id,
+                direct_assignments.name(assignment.role_id),
+                assignment.scope_id,
+                direct_assignments.name(assignment.scope_id),
+            )
+    ct = assignment_table.render()
+    store_snapshot(args.snapshot_db, "azure_active", ct)
+
     if args.test:
         logger.info("Test Mode: Skipping Confluence Update")
     else:
-        confluence_update_page(
-            confluence=confluence,
+        await confluence.publish(
             title=confluence_audit_azure_resources_page_name,
             parent_id=confluence_page_id,
             table=ct,
             representation="storage",
             full_width=False,
             escape_table=True,
+            shard_by=args.shard_by,
         )
 
 
@@ -174,13 +162,10 @@ async def main():
         prog="PIM EntraID Role Sync",
         description="Sync EntraID Role Assignments from Azure PIM to Confluence",
     )
-    parser.add_argument(
-        "-t",
-        "--test",
-        help="Dryrun the script without writing to Confluence",
-        action="store_true",
-    )
+    add_common_arguments(parser)
+    add_sharding_arguments(parser)
     args = parser.parse_args()
+    instrumentation.start(**instrumentation_options(args))
     if args.test:
         logger.info("Running in Test Mode")
 
@@ -188,9 +173,10 @@ async def main():
         azure_tenant_id=azure_tenant_id,
         azure_client_id=azure_client_id,
         azure_client_secret=azure_client_secret,
+        **graph_client_options(args),
     )
 
-    confluence = Confluence(url=confluence_url, token=confluence_token)
+    confluence = ConfluenceClient(url=confluence_url, token=confluence_token)
     await audit_azure_resources(
         graph_client=graph_client,
         confluence=confluence,
@@ -199,7 +185,9 @@ async def main():
 
 
 if __name__ == "__main__":
-    start = time.perf_counter()
-    asyncio.run(main())
-    end = time.perf_counter()
-    Kestra.timer("Full Duration", end - start)
+    # Metrics, profile and recording are also wanted for a failed run
+    try:
+        with stage("Full Duration"):
+            asyncio.run(main())
+    finally:
+        instrumentation.finish()
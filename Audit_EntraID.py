@@ -1,7 +1,6 @@
 import asyncio
 from kestra import Kestra
 import argparse
-import time
 
 
 from creds import (
@@ -13,11 +12,18 @@ from creds import (
     confluence_url,
     confluence_audit_entraid_page_name,
 )
-from functions.functions import get_assignments
-from functions.confluence import confluence_update_page
-from atlassian import Confluence
-from functions.msgraphapi import GraphAPI
-from msgraph.generated.models.group import Group
+from functions.instrumentation import instrumentation, stage
+from functions.datasets import RunDatasets
+from functions.snapshots import store_snapshot
+from functions.assignments import AssignmentTable, make_assignment
+from functions.confluence import ConfluenceClient
+from functions.msgraphapi import GraphAPI, GROUP_ODATA_TYPE
+from functions.cli import (
+    add_common_arguments,
+    add_sharding_arguments,
+    graph_client_options,
+    instrumentation_options,
+)
 
 logger = Kestra.logger()
 
@@ -35,92 +41,70 @@ def format_entraid_roles(roles):
     return role_out
 
 
-def convert_to_common_table(assignment_dict):
-    ct = []
-    for user in assignment_dict:
-        for role in assignment_dict[user]:
-            ct.append({"Benutzer": user, "Rolle": role})
-    ct = sorted(
-        ct,
-        key=lambda x: (x["Benutzer"], x["Rolle"]),
-        reverse=False,
-    )
-    return ct
-
-
-def check_pim(user=None, role=None, pim_assignment_dict=None):
-    if role in pim_assignment_dict and user in pim_assignment_dict[role]:
-        return True
-    return False
-
-
+@instrumentation.timed("Compare Assignments")
 async def audit_assignments(
-    assignments=None, role_dict=None, graph_client=None, pim_assignment_dict=None
+    assignments=None, role_dict=None, graph_client=None, pim_assignment_table=None
 ):
-    assignment_dict = {}
+    assignment_table = AssignmentTable()
+    group_ids = [
+        assignment.principal.id
+        for assignment in assignments
+        if assignment.principal.odata_type == GROUP_ODATA_TYPE
+    ]
+    members_by_group = await graph_client.get_members_of_groups(group_ids)
     for assignment in assignments:
-        role_name = role_dict[assignment.role_definition_id]["display_name"]
-        if isinstance(assignment.principal, Group):
-            group_members = await graph_client.get_group_members(
-                assignment.principal.id
-            )
-            if len(group_members) > 0:
-                for group_member in group_members:
-                    member_display_name = group_member.display_name
-                    if member_display_name not in assignment_dict:
-                        assignment_dict[member_display_name] = []
-                    if not check_pim(
-                        user=member_display_name,
-                        role=role_name,
-                        pim_assignment_dict=pim_assignment_dict,
-                    ):
-                        assignment_dict[member_display_name].append(role_name)
+        role_id = assignment.role_definition_id
+        role_name = role_dict[role_id]["display_name"]
+        if assignment.principal.odata_type == GROUP_ODATA_TYPE:
+            principals = members_by_group[assignment.principal.id]
         else:
-            user = assignment.principal.display_name
-            if user not in assignment_dict:
-                assignment_dict[user] = []
-            if not check_pim(
-                user=user, role=role_name, pim_assignment_dict=pim_assignment_dict
-            ):
-                assignment_dict[user].append(role_name)
-
-    ct = convert_to_common_table(assignment_dict)
+            principals = [assignment.principal]
+        for principal in principals:
+            # Matched on object IDs, so users sharing a display name stay apart
+            if make_assignment(principal.id, role_id) not in pim_assignment_table:
+                assignment_table.add(
+                    principal.id, principal.display_name, role_id, role_name
+                )
+
+    ct = assignment_table.render(columns=("Benutzer", "Rolle"))
     return ct
 
 
-async def audit_entraid(graph_client=None, confluence=None, args=None):
+async def audit_entraid(graph_client=None, confluence=None, args=None, datasets=None):
+    if datasets is None:
+        datasets = RunDatasets(graph_client=graph_client)
 
-    roles = await graph_client.get_entraid_roles()
+    roles, assignments = await asyncio.gather(
+        datasets.entraid_roles(), datasets.entraid_role_assignments()
+    )
     role_dict = format_entraid_roles(roles)
-    assignments = await graph_client.get_entraid_role_assignments()
 
     # Get all Current EntraID Role Assignments from Azure PIM
-    start_function = time.perf_counter()
-    logger.info("Getting EntraID Role Assignments from Azure PIM")
-    pim_assignment_dict = await get_assignments(graph_client)
-    # Convert the results to a usable table
-    logger.info("Building User Array")
-    end_function = time.perf_counter()
-    Kestra.timer("Load PIM Users", end_function - start_function)
+    with stage("Load PIM Users"):
+        logger.info("Getting EntraID Role Assignments from Azure PIM")
+        pim_assignment_table = await datasets.entraid_eligibility()
+        # Convert the results to a usable table
+        logger.info("Building User Array")
 
     ct = await audit_assignments(
         assignments=assignments,
         role_dict=role_dict,
         graph_client=graph_client,
-        pim_assignment_dict=pim_assignment_dict,
+        pim_assignment_table=pim_assignment_table,
     )
+    store_snapshot(args.snapshot_db, "entraid_active", ct)
 
     if args.test:
         logger.info("Test Mode: Skipping Confluence Update")
     else:
-        confluence_update_page(
-            confluence=confluence,
+        await confluence.publish(
             title=confluence_audit_entraid_page_name,
             parent_id=confluence_page_id,
             table=ct,
             representation="storage",
             full_width=False,
             escape_table=True,
+            shard_by=args.shard_by,
         )
 
 
@@ -129,13 +113,10 @@ async def main():
         prog="PIM EntraID Role Sync",
         description="Sync EntraID Role Assignments from Azure PIM to Confluence",
     )
-    parser.add_argument(
-        "-t",
-        "--test",
-        help="Dryrun the script without writing to Confluence",
-        action="store_true",
-    )
+    add_common_arguments(parser)
+    add_sharding_arguments(parser)
     args = parser.parse_args()
+    instrumentation.start(**instrumentation_options(args))
     if args.test:
         logger.info("Running in Test Mode")
 
@@ -143,13 +124,16 @@ async def main():
         azure_tenant_id=azure_tenant_id,
         azure_client_id=azure_client_id,
         azure_client_secret=azure_client_secret,
+        **graph_client_options(args),
     )
-    confluence = Confluence(url=confluence_url, token=confluence_token)
+    confluence = ConfluenceClient(url=confluence_url, token=confluence_token)
     await audit_entraid(graph_client=graph_client, confluence=confluence, args=args)
 
 
 if __name__ == "__main__":
-    start = time.perf_counter()
-    asyncio.run(main())
-    end = time.perf_counter()
-    Kestra.timer("Full Duration", end - start)
+    # Metrics, profile and recording are also wanted for a failed run
+    try:
+        with stage("Full Duration"):
+            asyncio.run(main())
+    finally:
+        instrumentation.finish()
@@ -1,7 +1,6 @@
 import asyncio
 from kestra import Kestra
 import argparse
-import time
 
 
 from creds import (
@@ -13,19 +12,24 @@ from creds import (
     confluence_url,
     confluence_entraid_page_name,
 )
-from functions.confluence import confluence_update_page, style_text
-from atlassian import Confluence
+from functions.instrumentation import instrumentation, stage
+from functions.confluence import ConfluenceClient, style_text
 
+from functions.datasets import RunDatasets
+from functions.snapshots import store_snapshot
 from functions.functions import (
-    get_assignments,
     build_user_array,
-    get_documented_mappings,
-    check_new_mappings,
-    check_removed_mappings,
+    load_documented_mappings,
+    diff_mappings,
 )
 
 
 from functions.msgraphapi import GraphAPI
+from functions.cli import (
+    add_common_arguments,
+    graph_client_options,
+    instrumentation_options,
+)
 
 # from functions.log_config import logger
 
@@ -33,91 +37,88 @@ logger = Kestra.logger()
 
 
 
-async def process_entra_id(graph_client=None, confluence=None, args=None):
-    
+async def process_entra_id(
+    graph_client=None, confluence=None, args=None, datasets=None
+):
+    if datasets is None:
+        datasets = RunDatasets(graph_client=graph_client)
+
+    # Read the documentation while the assignments are collected
+    documented = asyncio.ensure_future(
+        confluence.run(
+            load_documented_mappings, confluence_page_id, confluence_entraid_page_name
+        )
+    )
+
     # Get all Current EntraID Role Assignments from Azure PIM
-    start_function = time.perf_counter()
-    logger.info("Getting EntraID Role Assignments from Azure PIM")
-    assignment_dict = await get_assignments(graph_client)
-    # Convert the results to a usable table
-    logger.info("Building User Array")
-    user_array = build_user_array(assignment_dict)
-    end_function = time.perf_counter()
-    Kestra.timer('Load PIM Users', end_function - start_function)
+    with stage("Load PIM Users"):
+        logger.info("Getting EntraID Role Assignments from Azure PIM")
+        assignment_table = await datasets.entraid_eligibility()
+        # Convert the results to a usable table
+        logger.info("Building User Array")
+        user_array = build_user_array(assignment_table)
+        store_snapshot(args.snapshot_db, "entraid_eligible", user_array)
 
     # Get Currently Documented Role Mappings
-    start_function = time.perf_counter()
-    logger.info("Getting Documented Role Mappings")
-    role_mappings, headers = get_documented_mappings(
-        confluence, confluence_page_id, confluence_entraid_page_name
-    )
-    end_function = time.perf_counter()
-    Kestra.timer('Load Documented Users', end_function - start_function)
-
-    # Check for new mappings
-    start_function = time.perf_counter()
-    logger.info("Checking for new mappings")
-    role_mappings, new_mappings = check_new_mappings(user_array, role_mappings, headers)
-    end_function = time.perf_counter()
-    Kestra.timer('Check New Mappings', end_function - start_function)
-
-    # Remove mappings that are not in the export
-    start_function = time.perf_counter()
-    logger.info("Checking for removed mappings")
-    role_mappings, removed_mappings = check_removed_mappings(user_array, role_mappings)
-    end_function = time.perf_counter()
-    Kestra.timer('Check Removed Mappings', end_function - start_function)
+    with stage("Load Documented Users"):
+        logger.info("Getting Documented Role Mappings")
+        role_mappings, headers = await documented
+
+    # Compare the export against the documented mappings in a single pass
+    with stage("Compare Mappings"):
+        logger.info("Comparing with documented mappings")
+        added, removed, unchanged = diff_mappings(
+            current_mappings=user_array,
+            documented_mappings=role_mappings,
+            headers=headers,
+        )
+        role_mappings = unchanged + added
+        new_mappings = added or False
+        removed_mappings = removed or False
 
     # Sort the mappings by user name
-    start_function = time.perf_counter()
-    role_mappings = sorted(
-        role_mappings, key=lambda x: (x["Benutzer"], x["Rolle"]), reverse=False
-    )
-    if new_mappings or removed_mappings:
-        logger.info("Updating Confluence Page")
-        if not args.test:
-            confluence_update_page(
-                confluence=confluence,
-                title=confluence_entraid_page_name,
-                parent_id=confluence_page_id,
-                table=role_mappings,
-                representation="storage",
-                full_width=False,
-                escape_table=True,
-                body_header=style_text(
-                    "Achtung! Nur bestehende Einträge ergänzen, keine neue hinzufügen!<br/>Bei Bedarf an neuen rechten bitte via Incident",
-                    color="red",
-                    bold=True,
-                ),
-            )
-        from pprint import pprint
-        pprint(new_mappings)
-        pprint(removed_mappings)
-        Kestra.outputs(
-            {
-                "status": "Changes Synchronised",
-                "new_mappings": new_mappings,
-                "removed_mappings": removed_mappings,
-            }
+    with stage("Upload_To_Confluence"):
+        role_mappings = sorted(
+            role_mappings, key=lambda x: (x["Benutzer"], x["Rolle"]), reverse=False
         )
-    else:
-        logger.info("No changes detected")
-        Kestra.outputs({"status": "No changes detected"})
-    end_function = time.perf_counter()
-    Kestra.timer('Upload_To_Confluence', end_function - start_function)
+        if new_mappings or removed_mappings:
+            logger.info("Updating Confluence Page")
+            if not args.test:
+                await confluence.publish(
+                    title=confluence_entraid_page_name,
+                    parent_id=confluence_page_id,
+                    table=role_mappings,
+                    representation="storage",
+                    full_width=False,
+                    escape_table=True,
+                    body_header=style_text(
+                        "Achtung! Nur bestehende Einträge ergänzen, keine neue hinzufügen!<br/>Bei Bedarf an neuen rechten bitte via Incident",
+                        color="red",
+                        bold=True,
+                    ),
+                )
+            from pprint import pprint
+            pprint(new_mappings)
+            pprint(removed_mappings)
+            Kestra.outputs(
+                {
+                    "status": "Changes Synchronised",
+                    "new_mappings": new_mappings,
+                    "removed_mappings": removed_mappings,
+                }
+            )
+        else:
+            logger.info("No changes detected")
+            Kestra.outputs({"status": "No changes detected"})
 
 async def main():
     parser = argparse.ArgumentParser(
         prog="PIM EntraID Role Sync",
         description="Sync EntraID Role Assignments from Azure PIM to Confluence",
     )
-    parser.add_argument(
-        "-t",
-        "--test",
-        help="Dryrun the script without writing to Confluence",
-        action="store_true",
-    )
+    add_common_arguments(parser)
     args = parser.parse_args()
+    instrumentation.start(**instrumentation_options(args))
     if args.test:
         logger.info("Running in Test Mode")
 
@@ -125,13 +126,16 @@ async def main():
         azure_tenant_id=azure_tenant_id,
         azure_client_id=azure_client_id,
         azure_client_secret=azure_client_secret,
+        **graph_client_options(args),
     )
-    confluence = Confluence(url=confluence_url, token=confluence_token)
+    confluence = ConfluenceClient(url=confluence_url, token=confluence_token)
     await process_entra_id(graph_client=graph_client, confluence=confluence, args=args)
 
 
 if __name__ == "__main__":
-    start = time.perf_counter()
-    asyncio.run(main())
-    end = time.perf_counter()
-    Kestra.timer('Full Duration', end - start)
\ No newline at end of file
+    # Metrics, profile and recording are also wanted for a failed run
+    try:
+        with stage("Full Duration"):
+            asyncio.run(main())
+    finally:
+        instrumentation.finish()
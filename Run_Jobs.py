@@ -0,0 +1,124 @@
+import asyncio
+from kestra import Kestra
+import argparse
+
+from creds import (
+    azure_tenant_id,
+    azure_client_id,
+    azure_client_secret,
+    confluence_token,
+    confluence_url,
+)
+from functions.instrumentation import instrumentation, stage
+from functions.confluence import ConfluenceClient
+from functions.msgraphapi import GraphAPI
+from functions.datasets import RunDatasets
+from functions.cli import (
+    add_common_arguments,
+    add_azure_arguments,
+    add_sharding_arguments,
+    graph_client_options,
+    instrumentation_options,
+)
+from PIM_EntraID_Roles import process_entra_id
+from PIM_Azure_Resources import process_azure_resources
+from Audit_EntraID import audit_entraid
+from Audit_Azure_Resources import audit_azure_resources
+
+logger = Kestra.logger()
+
+# Job name -> (entry point, datasets it reads)
+JOBS = {
+    "pim-entraid": (process_entra_id, ["entraid_eligibility"]),
+    "audit-entraid": (
+        audit_entraid,
+        ["entraid_roles", "entraid_role_assignments", "entraid_eligibility"],
+    ),
+    "pim-azure": (
+        process_azure_resources,
+        ["azure_subscriptions", "azure_eligibility"],
+    ),
+    "audit-azure": (
+        audit_azure_resources,
+        ["azure_subscriptions", "user_display_names"],
+    ),
+}
+
+
+async def run_jobs(jobs=None, graph_client=None, confluence=None, args=None):
+    datasets = RunDatasets(graph_client=graph_client)
+    # A job named twice would only publish the same result twice
+    jobs = list(dict.fromkeys(jobs))
+
+    # Start fetching everything the selected jobs need at once, the jobs then
+    # pick up the shared results as they become available
+    names = list(dict.fromkeys(name for job in jobs for name in JOBS[job][1]))
+    logger.info(f"Prefetching datasets: {', '.join(names)}")
+    prefetch = asyncio.ensure_future(
+        datasets.prefetch(
+            names,
+            azure_eligibility={
+                "source": args.eligibility_source,
+                "max_workers": args.subscription_workers,
+            },
+        )
+    )
+
+    try:
+        for job in jobs:
+            logger.info(f"Running job {job}")
+            with stage(f"Job {job}"):
+                entry_point, _ = JOBS[job]
+                await entry_point(
+                    graph_client=graph_client,
+                    confluence=confluence,
+                    args=args,
+                    datasets=datasets,
+                )
+        await prefetch
+    finally:
+        # A failed job leaves datasets nobody waits for any more
+        prefetch.cancel()
+        await asyncio.gather(prefetch, return_exceptions=True)
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        prog="PIM Audit Jobs",
+        description="Run several PIM sync and audit jobs in one process with shared data",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Jobs to run, in order",
+        nargs="+",
+        choices=list(JOBS),
+        default=list(JOBS),
+    )
+    add_common_arguments(parser)
+    add_azure_arguments(parser)
+    add_sharding_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.start(**instrumentation_options(args))
+    if args.test:
+        logger.info("Running in Test Mode")
+
+    graph_client = GraphAPI(
+        azure_tenant_id=azure_tenant_id,
+        azure_client_id=azure_client_id,
+        azure_client_secret=azure_client_secret,
+        **graph_client_options(args),
+    )
+    confluence = ConfluenceClient(url=confluence_url, token=confluence_token)
+    await run_jobs(
+        jobs=args.jobs, graph_client=graph_client, confluence=confluence, args=args
+    )
+
+
+if __name__ == "__main__":
+    # Metrics, profile and recording are also wanted for a failed run
+    try:
+        with stage("Full Duration"):
+            asyncio.run(main())
+    finally:
+        instrumentation.finish()
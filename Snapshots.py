@@ -0,0 +1,63 @@
+import argparse
+from datetime import date
+from tabulate import tabulate
+
+from functions.snapshots import SnapshotStore, DATASETS
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="PIM Snapshots",
+        description="Query the stored assignment snapshots without Graph or Confluence",
+    )
+    parser.add_argument("snapshot_db", help="SQLite file written via --snapshot-db")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    runs_parser = subparsers.add_parser("runs", help="List the stored snapshots")
+    runs_parser.add_argument("-d", "--dataset", choices=DATASETS)
+
+    diff_parser = subparsers.add_parser("diff", help="Compare two snapshots")
+    diff_parser.add_argument("dataset", choices=DATASETS)
+    diff_parser.add_argument("from_date", help="YYYY-MM-DD")
+    diff_parser.add_argument("to_date", help="YYYY-MM-DD", nargs="?")
+
+    who_parser = subparsers.add_parser(
+        "who", help="Show who had a role, or what a user had, on a given day"
+    )
+    who_parser.add_argument("on_date", help="YYYY-MM-DD")
+    who_parser.add_argument("-r", "--role")
+    who_parser.add_argument("-u", "--user")
+    who_parser.add_argument("-s", "--scope")
+    who_parser.add_argument("-d", "--dataset", choices=DATASETS, action="append")
+    args = parser.parse_args()
+
+    snapshot_store = SnapshotStore(args.snapshot_db)
+    if args.command == "runs":
+        print(
+            tabulate(
+                snapshot_store.runs(args.dataset),
+                headers=["Datum", "Dataset", "Zeilen"],
+            )
+        )
+    elif args.command == "diff":
+        added, removed = snapshot_store.diff(
+            args.dataset, args.from_date, args.to_date or date.today().isoformat()
+        )
+        rows = [("+", *row) for row in added] + [("-", *row) for row in removed]
+        print(tabulate(rows, headers=["", "Benutzer", "Rolle", "Scope"]))
+    elif args.command == "who":
+        rows = snapshot_store.who_had(
+            args.on_date,
+            role=args.role,
+            user=args.user,
+            scope=args.scope,
+            datasets=args.dataset or DATASETS,
+        )
+        print(
+            tabulate(rows, headers=["Dataset", "Datum", "Benutzer", "Rolle", "Scope"])
+        )
+    snapshot_store.close()
+
+
+if __name__ == "__main__":
+    main()
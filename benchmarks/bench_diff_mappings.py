@@ -0,0 +1,133 @@
+import argparse
+import copy
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from functions.functions import diff_mappings
+
+
+# Previous nested-scan implementations, kept here as the comparison baseline
+def legacy_check_new(existing_role_mappings, new_role_mappings, headers):
+    changes = []
+    for new_role_mapping in new_role_mappings:
+        mapped = False
+        for existing_role_mapping in existing_role_mappings:
+            if (
+                new_role_mapping["Benutzer"] == existing_role_mapping["Benutzer"]
+                and new_role_mapping["Rolle"] == existing_role_mapping["Rolle"]
+                and new_role_mapping["Scope"] == existing_role_mapping["Scope"]
+            ):
+                mapped = True
+                break
+        if not mapped:
+            for header in headers:
+                if header not in new_role_mapping:
+                    new_role_mapping[header] = ""
+            existing_role_mappings.append(new_role_mapping)
+            changes.append(new_role_mapping)
+    return existing_role_mappings, changes
+
+
+def legacy_check_removed(existing_role_mappings, new_role_mappings):
+    changes = [
+        mapping
+        for mapping in existing_role_mappings
+        if not any(
+            (
+                new_mapping["Benutzer"] == mapping["Benutzer"]
+                and new_mapping["Rolle"] == mapping["Rolle"]
+                and new_mapping["Scope"] == mapping["Scope"]
+            )
+            for new_mapping in new_role_mappings
+        )
+    ]
+    for change in changes:
+        existing_role_mappings.remove(change)
+    return existing_role_mappings, changes
+
+
+def generate_mappings(rows, churn=0.05, seed=42):
+    random.seed(seed)
+    users = [f"User {i}" for i in range(max(rows // 20, 1))]
+    roles = ["Owner", "Contributor", "Reader", "User Access Administrator"]
+    documented = []
+    seen = set()
+    while len(documented) < rows:
+        key = (
+            random.choice(users),
+            random.choice(roles),
+            f"/subscriptions/sub-{random.randint(0, rows // 10)}",
+        )
+        if key in seen:
+            continue
+        seen.add(key)
+        documented.append(
+            {"Benutzer": key[0], "Rolle": key[1], "Scope": key[2], "Kommentar": ""}
+        )
+    current = [
+        {"Benutzer": x["Benutzer"], "Rolle": x["Rolle"], "Scope": x["Scope"]}
+        for x in documented[int(rows * churn) :]
+    ]
+    for i in range(int(rows * churn)):
+        current.append(
+            {"Benutzer": f"New User {i}", "Rolle": "Owner", "Scope": "/subscriptions/new"}
+        )
+    return current, documented
+
+
+def run_legacy(current, documented, headers):
+    role_mappings, _ = legacy_check_new(documented, current, headers)
+    legacy_check_removed(role_mappings, current)
+
+
+def run_keyed(current, documented, headers):
+    diff_mappings(
+        current_mappings=current,
+        documented_mappings=documented,
+        keys=("Benutzer", "Rolle", "Scope"),
+        headers=headers,
+    )
+
+
+def timed(function, current, documented, headers):
+    current = copy.deepcopy(current)
+    documented = copy.deepcopy(documented)
+    start = time.perf_counter()
+    function(current, documented, headers)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="Diff Mappings Benchmark",
+        description="Compare the keyed diff engine against the nested list scans",
+    )
+    parser.add_argument(
+        "-s", "--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000]
+    )
+    parser.add_argument(
+        "--legacy-limit",
+        type=int,
+        default=10_000,
+        help="Largest size the quadratic implementation is run for",
+    )
+    args = parser.parse_args()
+
+    headers = ["Benutzer", "Rolle", "Scope", "Kommentar"]
+    print(f"{'rows':>8} {'legacy (s)':>12} {'keyed (s)':>12} {'speedup':>10}")
+    for size in args.sizes:
+        current, documented = generate_mappings(size)
+        keyed = timed(run_keyed, current, documented, headers)
+        if size <= args.legacy_limit:
+            legacy = timed(run_legacy, current, documented, headers)
+            print(f"{size:>8} {legacy:>12.3f} {keyed:>12.3f} {legacy / keyed:>9.0f}x")
+        else:
+            print(f"{size:>8} {'skipped':>12} {keyed:>12.3f} {'-':>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import importlib.util
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from functions.confluence import convert_to_html_table
+
+
+# Previous DataFrame based renderer, kept here as the comparison baseline
+def legacy_convert_to_html_table(data=None, escape=True, transpose_table=False):
+    import pandas as pd
+
+    df = pd.DataFrame(data)
+    if transpose_table:
+        html_table = df.T.to_html(index=False, escape=escape)
+    else:
+        html_table = df.to_html(index=False, escape=escape)
+    return html_table
+
+
+def generate_rows(rows, seed=42):
+    random.seed(seed)
+    roles = ["Owner", "Contributor", "Reader", "User Access Administrator"]
+    return [
+        {
+            "Benutzer": f"User {random.randint(0, rows // 20)} <user@example.com>",
+            "Rolle": random.choice(roles),
+            "Scope": f"Subscription sub-{random.randint(0, rows // 10)} & more",
+            "Kommentar": "",
+        }
+        for _ in range(rows)
+    ]
+
+
+def measure(function, data):
+    tracemalloc.start()
+    start = time.perf_counter()
+    function(data=data, escape=True)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, peak / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="HTML Table Benchmark",
+        description="Compare the streaming table renderer against DataFrame.to_html",
+    )
+    parser.add_argument(
+        "-s", "--sizes", type=int, nargs="+", default=[1_000, 10_000, 50_000]
+    )
+    args = parser.parse_args()
+
+    has_pandas = importlib.util.find_spec("pandas") is not None
+    if has_pandas:
+        start = time.perf_counter()
+        import pandas  # noqa: F401
+
+        print(f"pandas import: {time.perf_counter() - start:.3f}s")
+    else:
+        print("pandas is not installed, only the streaming renderer is measured")
+
+    print(
+        f"{'rows':>8} {'pandas (s)':>11} {'pandas (MiB)':>13} "
+        f"{'stream (s)':>11} {'stream (MiB)':>13}"
+    )
+    for size in args.sizes:
+        data = generate_rows(size)
+        stream_time, stream_memory = measure(convert_to_html_table, data)
+        if has_pandas:
+            pandas_time, pandas_memory = measure(legacy_convert_to_html_table, data)
+            pandas_columns = f"{pandas_time:>11.3f} {pandas_memory:>13.1f}"
+        else:
+            pandas_columns = f"{'-':>11} {'-':>13}"
+        print(f"{size:>8} {pandas_columns} {stream_time:>11.3f} {stream_memory:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
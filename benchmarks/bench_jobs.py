@@ -0,0 +1,239 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import statistics
+import sys
+import time
+from argparse import Namespace
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from replay_server import ReplayServer, load_exchanges
+from synthetic_tenant import SyntheticTenant, install_creds
+
+# The entry points import their settings from creds, so it has to exist first
+creds = install_creds()
+
+from azure.core.credentials import AccessToken
+from azure.core.pipeline.policies import SansIOHTTPPolicy
+from functions import functions
+from functions.confluence import ConfluenceClient
+from functions.instrumentation import instrumentation
+from functions.msgraphapi import GraphAPI
+from Run_Jobs import JOBS, run_jobs
+
+# Entry point of the single process runner next to the individual jobs
+ALL_JOBS = "all"
+
+
+class StaticTokenCredential:
+    # Async credential for the Graph clients, the replay server accepts any token
+    async def get_token(self, *scopes, **kwargs):
+        return AccessToken("replay", int(time.time()) + 3600)
+
+    async def close(self):
+        pass
+
+
+class StaticTokenPolicy(SansIOHTTPPolicy):
+    # Replaces the bearer token policy of the ARM clients, which refuses http
+    def on_request(self, request):
+        request.http_request.headers["Authorization"] = "Bearer replay"
+
+
+def job_args(args):
+    return Namespace(
+        test=False,
+        snapshot_db=None,
+        shard_by=None,
+        eligibility_source="resourcegraph",
+        subscription_workers=args.subscription_workers,
+    )
+
+
+def request_count():
+    return sum(stats.requests for stats in instrumentation.endpoints.values())
+
+
+async def run_job(job, server, args):
+    graph_client = GraphAPI(
+        azure_tenant_id=creds.azure_tenant_id,
+        azure_client_id=creds.azure_client_id,
+        azure_client_secret=creds.azure_client_secret,
+        max_concurrency=args.concurrency,
+        base_url=f"{server.url('graph')}/v1.0",
+        credential=StaticTokenCredential(),
+    )
+    confluence = ConfluenceClient(url=server.url("confluence"), token="replay")
+    if job == ALL_JOBS:
+        await run_jobs(
+            jobs=list(JOBS),
+            graph_client=graph_client,
+            confluence=confluence,
+            args=job_args(args),
+        )
+    else:
+        entry_point, _ = JOBS[job]
+        await entry_point(
+            graph_client=graph_client, confluence=confluence, args=job_args(args)
+        )
+
+
+async def measure(job, server, args):
+    results = []
+    for _ in range(args.iterations):
+        # Every iteration starts from the freshly loaded fixtures
+        server.reset()
+        requests = request_count()
+        start = time.perf_counter()
+        output = io.StringIO() if not args.verbose else sys.stdout
+        with contextlib.redirect_stdout(output):
+            await run_job(job, server, args)
+        results.append(
+            {
+                "seconds": time.perf_counter() - start,
+                "requests": request_count() - requests,
+                "server_requests": sum(server.stats["requests"].values()),
+                "throttled": server.stats["throttled"],
+                "unmatched": len(server.stats["unmatched"]),
+            }
+        )
+    # The first iteration also pays for the lazy SDK imports
+    return {
+        "first_seconds": results[0]["seconds"],
+        "seconds": statistics.median(result["seconds"] for result in results),
+        "min_seconds": min(result["seconds"] for result in results),
+        "requests": max(result["requests"] for result in results),
+        "server_requests": max(result["server_requests"] for result in results),
+        "throttled": sum(result["throttled"] for result in results),
+        "unmatched": max(result["unmatched"] for result in results),
+    }
+
+
+async def run_benchmark(server, args):
+    # One event loop for all runs, as in production the shared request
+    # scheduler is bound to the loop it first ran on
+    print(
+        f"{'job':>14} {'first (s)':>10} {'median (s)':>11} {'min (s)':>8} "
+        f"{'requests':>9} {'throttled':>10} {'unmatched':>10}"
+    )
+    results = {}
+    for job in args.jobs:
+        result = await measure(job, server, args)
+        results[job] = result
+        print(
+            f"{job:>14} {result['first_seconds']:>10.2f} {result['seconds']:>11.2f} "
+            f"{result['min_seconds']:>8.2f} {result['requests']:>9} "
+            f"{result['throttled']:>10} {result['unmatched']:>10}"
+        )
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Slower than the baseline by more than the tolerance or more requests
+    # than before counts as a regression
+    regressions = []
+    for job, result in results.items():
+        if result["unmatched"]:
+            regressions.append(
+                f"{job}: {result['unmatched']} requests had no recorded response"
+            )
+        before = baseline.get(job)
+        if not before:
+            continue
+        if result["seconds"] > before["seconds"] * (1 + tolerance):
+            regressions.append(
+                f"{job}: {result['seconds']:.2f}s against {before['seconds']:.2f}s"
+            )
+        if result["requests"] > before["requests"]:
+            regressions.append(
+                f"{job}: {result['requests']} requests against {before['requests']}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="Job Benchmark",
+        description="Run the sync and audit jobs against the replay server",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        nargs="+",
+        choices=[*JOBS, ALL_JOBS],
+        default=[*JOBS, ALL_JOBS],
+    )
+    parser.add_argument(
+        "-f",
+        "--fixtures",
+        nargs="+",
+        help="Recorded JSONL exchanges, a synthetic tenant is generated otherwise",
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--subscriptions", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("-n", "--iterations", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("-c", "--concurrency", type=int, default=10)
+    parser.add_argument("--subscription-workers", type=int, default=8)
+    parser.add_argument("-o", "--output", help="Write the results as JSON")
+    parser.add_argument("-b", "--baseline", help="Results JSON to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed slowdown against the baseline before it counts as a regression",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    if args.fixtures:
+        exchanges = list(load_exchanges(args.fixtures))
+    else:
+        tenant = SyntheticTenant(
+            users=args.users,
+            groups=args.groups,
+            subscriptions=args.subscriptions,
+            depth=args.depth,
+        )
+        exchanges = list(tenant.exchanges())
+    server = ReplayServer(
+        exchanges,
+        latency=args.latency,
+        jitter=args.jitter,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        seed=0,
+    )
+    server.start()
+    functions.AZURE_CLIENT_OVERRIDES.update(
+        base_url=server.url("arm"), authentication_policy=StaticTokenPolicy()
+    )
+    results = asyncio.run(run_benchmark(server, args))
+    server.shutdown()
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
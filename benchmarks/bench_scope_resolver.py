@@ -0,0 +1,117 @@
+import argparse
+import contextlib
+import io
+import random
+import re
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from functions.scopes import ScopeResolver
+
+
+# Previous per-row implementation from Audit_Azure_Resources.py
+def legacy_subscription_translate(
+    scope, subscription_dict, subscription_id_exclusions, subscription_exclusions
+):
+    print(scope)
+    regexp = r"(^\/subscriptions\/)([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(.*)"
+    match = re.search(regexp, scope)
+    if match:
+        start = match.group(1)
+        subscription_id = match.group(2)
+        end = match.group(3)
+    else:
+        return scope
+
+    if subscription_id in subscription_dict:
+        subscription = subscription_dict[subscription_id]
+    else:
+        subscription = subscription_id
+    for exclusion in subscription_id_exclusions:
+        if exclusion == subscription_id:
+            return False
+    for exclusion in subscription_exclusions:
+        if exclusion in subscription.lower():
+            return False
+    return f"{start}{subscription}{end}"
+
+
+def legacy_check_role_exclusions(role, role_exclusions):
+    for exclusion in role_exclusions:
+        if exclusion in role:
+            return False
+    return True
+
+
+def generate_scopes(rows, subscriptions=600, seed=42):
+    random.seed(seed)
+    subscription_dict = {
+        str(uuid.UUID(int=random.getrandbits(128))): f"sub-{i}"
+        for i in range(subscriptions)
+    }
+    subscription_ids = list(subscription_dict)
+    resource_groups = [f"rg-{i}" for i in range(50)]
+    roles = ["Owner", "Contributor", "Reader", "Key Vault Administrator"]
+    resources = []
+    for _ in range(rows):
+        scope = f"/subscriptions/{random.choice(subscription_ids)}"
+        if random.random() < 0.7:
+            scope += f"/resourceGroups/{random.choice(resource_groups)}"
+        resources.append((scope, random.choice(roles)))
+    return subscription_dict, resources
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="Scope Resolver Benchmark",
+        description="Compare ScopeResolver against the per-row scope translation",
+    )
+    parser.add_argument("-r", "--rows", type=int, default=200_000)
+    args = parser.parse_args()
+
+    subscription_dict, resources = generate_scopes(args.rows)
+    subscription_id_exclusions = list(subscription_dict)[:20]
+    subscription_exclusions = [f"sub-{i}9" for i in range(30)] + ["developer"]
+    role_exclusions = ["Key Vault", "Backup", "Monitoring"]
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        legacy = [
+            legacy_subscription_translate(
+                scope,
+                subscription_dict,
+                subscription_id_exclusions,
+                subscription_exclusions,
+            )
+            and legacy_check_role_exclusions(role, role_exclusions)
+            for scope, role in resources
+        ]
+    legacy_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scope_resolver = ScopeResolver(
+        subscription_dict=subscription_dict,
+        subscription_id_exclusions=subscription_id_exclusions,
+        subscription_exclusions=subscription_exclusions,
+        role_exclusions=role_exclusions,
+    )
+    resolved = [
+        scope_resolver.translate(scope) and scope_resolver.check_role(role)
+        for scope, role in resources
+    ]
+    resolver_duration = time.perf_counter() - start
+
+    assert legacy == resolved
+    print(f"{'rows':>8} {'legacy (s)':>12} {'resolver (s)':>13} {'speedup':>10}")
+    print(
+        f"{args.rows:>8} {legacy_duration:>12.3f} {resolver_duration:>13.3f} "
+        f"{legacy_duration / resolver_duration:>9.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
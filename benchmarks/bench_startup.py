@@ -0,0 +1,152 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from synthetic_tenant import SYNTHETIC_CREDS
+
+ROOT = Path(__file__).resolve().parent.parent
+SCRIPTS = [
+    "PIM_EntraID_Roles.py",
+    "PIM_Azure_Resources.py",
+    "Audit_EntraID.py",
+    "Audit_Azure_Resources.py",
+    "Run_Jobs.py",
+    "Snapshots.py",
+]
+# SDKs only needed once a job talks to Graph, ARM or Confluence, importing
+# one of them before the arguments are parsed counts as a regression
+DEFERRED_MODULES = [
+    "msgraph",
+    "msgraph_core",
+    "kiota_abstractions",
+    "kiota_http",
+    "azure.identity",
+    "azure.mgmt",
+    "atlassian",
+    "lxml",
+    "httpx",
+    "pandas",
+]
+
+
+def write_creds(directory):
+    # The scripts import their settings from creds before parsing arguments
+    path = os.path.join(directory, "creds.py")
+    with open(path, "w") as creds:
+        for name, value in SYNTHETIC_CREDS.items():
+            creds.write(f"{name} = {value!r}\n")
+    return path
+
+
+def parse_importtime(stderr):
+    # Lines look like "import time:  self [us] | cumulative | imported package"
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        imports.append((name.strip(), int(cumulative)))
+    return imports
+
+
+def run_script(script, script_args, env):
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", script, *script_args],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    seconds = time.perf_counter() - start
+    if process.returncode:
+        raise RuntimeError(f"{script} exited with {process.returncode}")
+    return seconds, parse_importtime(process.stderr)
+
+
+def deferred_imports(imports):
+    return sorted(
+        {
+            name
+            for name, _ in imports
+            if any(
+                name == module or name.startswith(f"{module}.")
+                for module in DEFERRED_MODULES
+            )
+        }
+    )
+
+
+def measure(script, script_args, env, iterations):
+    # The best run, the others mostly measure a cold file system cache
+    runs = [run_script(script, script_args, env) for _ in range(iterations)]
+    seconds, imports = min(runs, key=lambda run: run[0])
+    return {
+        "seconds": seconds,
+        "imports": imports,
+        "deferred": deferred_imports(imports),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="Startup Benchmark",
+        description="Check the startup time and imports of the entry points",
+    )
+    parser.add_argument("scripts", nargs="*", default=SCRIPTS)
+    parser.add_argument(
+        "-a",
+        "--args",
+        nargs="+",
+        default=["--help"],
+        help="Arguments passed to every script",
+    )
+    parser.add_argument("-n", "--iterations", type=int, default=5)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=0.5,
+        help="Maximum wall time in seconds for one script start",
+    )
+    parser.add_argument(
+        "--top", type=int, default=5, help="Slowest imports listed per script"
+    )
+    args = parser.parse_args()
+
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        write_creds(directory)
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [directory, env.get("PYTHONPATH")])
+        )
+        print(f"{'script':>26} {'seconds':>8} {'budget':>7}")
+        for script in args.scripts:
+            result = measure(script, args.args, env, args.iterations)
+            status = "ok" if result["seconds"] <= args.budget else "over"
+            print(f"{script:>26} {result['seconds']:>8.3f} {status:>7}")
+            for name, cumulative in sorted(
+                result["imports"], key=lambda item: item[1], reverse=True
+            )[: args.top]:
+                print(f"{'':>28}{cumulative / 1000:>8.1f} ms  {name}")
+            if status != "ok":
+                failures.append(
+                    f"{script}: {result['seconds']:.3f}s over the {args.budget}s budget"
+                )
+            if result["deferred"]:
+                failures.append(
+                    f"{script}: imports {', '.join(result['deferred'])} at startup"
+                )
+
+    for failure in failures:
+        print(f"Regression: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
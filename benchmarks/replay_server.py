@@ -0,0 +1,490 @@
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, parse_qsl, unquote, urlsplit
+
+# Recorded and synthetic exchanges name the services by placeholder, the
+# server answers each of them under its own path prefix
+PREFIXES = {"{graph}": "/graph", "{arm}": "/arm", "{confluence}": "/confluence"}
+# Families that get 429 responses injected, Confluence has no retry handling
+THROTTLED_FAMILIES = {"graph", "arm"}
+SPACE_KEY = "PIM"
+
+
+def normalize_path(path):
+    # Kiota calls functions such as delta with an empty argument list
+    return unquote(path).rstrip("/").removesuffix("()").lower()
+
+
+def normalize_query(query):
+    # Parameter order and empty values differ between SDK versions
+    return tuple(
+        sorted(
+            (key.lower(), value)
+            for key, value in parse_qsl(query, keep_blank_values=True)
+            if value
+        )
+    )
+
+
+def body_key(body):
+    if not body:
+        return ""
+    if isinstance(body, dict) and "query" in body:
+        # Resource Graph pages are told apart by query and skip token, the
+        # subscription chunk depends on the run configuration
+        options = body.get("options") or {}
+        body = [" ".join(body["query"].split()), options.get("$skipToken")]
+    return hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest()
+
+
+def json_response(status, payload, headers=None):
+    return (
+        status,
+        {"content-type": "application/json", **(headers or {})},
+        json.dumps(payload).encode() if payload is not None else b"",
+    )
+
+
+def load_exchanges(paths):
+    for path in paths:
+        with open(path) as fixture:
+            for line in fixture:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def iter_objects(value):
+    # Every directory object anywhere in a Graph response
+    if isinstance(value, dict):
+        if "id" in value and "@odata.type" in value:
+            yield value
+        for item in value.values():
+            yield from iter_objects(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_objects(item)
+
+
+class FixtureStore:
+    # Answers requests from recorded exchanges, first by method, path, query
+    # and body, then by method and path alone. Repeated identical requests
+    # step through their recorded responses and stay on the last one.
+    def __init__(self, exchanges, base_url):
+        self.base_url = base_url
+        self.exact = {}
+        self.fallback = {}
+        self.objects = {}
+        self.cursors = {}
+        self.lock = threading.Lock()
+        # Confluence is served from memory, recorded reads only seed its pages
+        self.confluence_seed = {}
+        for exchange in exchanges:
+            self.add(exchange)
+
+    def substitute(self, text, absolute=True):
+        for placeholder, prefix in PREFIXES.items():
+            text = text.replace(
+                placeholder, self.base_url + prefix if absolute else prefix
+            )
+        return text
+
+    def add(self, exchange):
+        if "confluence_page" in exchange:
+            page = exchange["confluence_page"]
+            self.confluence_seed[str(page["id"])] = page
+            return
+        if exchange["url"].startswith("{confluence}"):
+            self.seed_confluence(exchange)
+            return
+        url = urlsplit(self.substitute(exchange["url"], absolute=False))
+        method = exchange["method"].upper()
+        body = exchange.get("body")
+        payload = self.substitute(json.dumps(body)) if body is not None else ""
+        response = (
+            exchange.get("status") or 200,
+            {"content-type": "application/json", **(exchange.get("headers") or {})},
+            payload.encode(),
+        )
+        path = normalize_path(url.path)
+        request_body = (exchange.get("request") or {}).get("body")
+        key = (method, path, normalize_query(url.query), body_key(request_body))
+        self.exact.setdefault(key, []).append(response)
+        for fallback_key in ((method, path, body_key(request_body)), (method, path)):
+            self.fallback.setdefault(fallback_key, response)
+        if path.startswith("/graph"):
+            for graph_object in iter_objects(body):
+                self.objects.setdefault(graph_object["id"], graph_object)
+
+    def seed_confluence(self, exchange):
+        body = exchange.get("body")
+        parts = [part for part in urlsplit(exchange["url"]).path.split("/") if part]
+        if exchange["method"] != "GET" or exchange.get("status") != 200:
+            return
+        if parts[1:4] != ["rest", "api", "content"] or len(parts) < 5:
+            return
+        page_id = parts[4]
+        page = self.confluence_seed.setdefault(page_id, {"id": page_id, "title": ""})
+        if len(parts) == 5 and isinstance(body, dict):
+            page["title"] = body.get("title", page["title"])
+            storage = (body.get("body") or {}).get("storage") or {}
+            page["body"] = storage.get("value", page.get("body", ""))
+            if body.get("ancestors"):
+                page["parent_id"] = body["ancestors"][-1]["id"]
+        elif parts[5:6] == ["child"] and isinstance(body, dict):
+            for child in body.get("results", []):
+                seeded = self.confluence_seed.setdefault(
+                    child["id"], {"id": child["id"], "title": child.get("title", "")}
+                )
+                seeded["parent_id"] = page_id
+
+    def lookup(self, method, path, query, body):
+        path = normalize_path(path)
+        key = (method, path, normalize_query(query), body_key(body))
+        responses = self.exact.get(key)
+        if responses:
+            with self.lock:
+                index = self.cursors.get(key, 0)
+                self.cursors[key] = min(index + 1, len(responses) - 1)
+            return responses[index]
+        return self.fallback.get((method, path, body_key(body))) or self.fallback.get(
+            (method, path)
+        )
+
+    def get_by_ids(self, body):
+        ids = (body or {}).get("ids", [])
+        return json_response(
+            200, {"value": [self.objects[i] for i in ids if i in self.objects]}
+        )
+
+    def reset(self):
+        with self.lock:
+            self.cursors = {}
+
+
+class ConfluenceStore:
+    # Just enough of the Confluence Server REST API for atlassian.Confluence:
+    # pages with storage bodies, versions, children and content properties
+    def __init__(self, seed=()):
+        self.seed = list(seed)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.pages = {}
+            self.ids = itertools.count(100_000)
+            for page in self.seed:
+                self._create(
+                    page["title"],
+                    page.get("body", ""),
+                    page.get("parent_id"),
+                    page_id=str(page["id"]),
+                )
+
+    def _create(self, title, body, parent_id, page_id=None):
+        page_id = page_id or str(next(self.ids))
+        self.pages[page_id] = {
+            "id": page_id,
+            "title": title,
+            "body": body,
+            "parent_id": parent_id,
+            "version": 1,
+            "properties": {},
+        }
+        return self.pages[page_id]
+
+    def render(self, page, expand=""):
+        content = {
+            "id": page["id"],
+            "type": "page",
+            "status": "current",
+            "title": page["title"],
+            "space": {"key": SPACE_KEY},
+            "version": {"number": page["version"]},
+            "body": {"storage": {"value": page["body"], "representation": "storage"}},
+            "_links": {"tinyui": f"/x/{page['id']}"},
+        }
+        if "ancestors" in expand and page["parent_id"] in self.pages:
+            content["ancestors"] = [{"id": page["parent_id"], "type": "page"}]
+        return content
+
+    def children(self, page_id):
+        return [
+            {"id": page["id"], "type": "page", "title": page["title"]}
+            for page in self.pages.values()
+            if page["parent_id"] == page_id
+        ]
+
+    def handle(self, method, path, query, body):
+        params = {key: values[-1] for key, values in parse_qs(query).items()}
+        parts = [part for part in path.split("/") if part]
+        # rest/api/content[/id[/child/page|/history|/property[/key]]]
+        if parts[:3] != ["rest", "api", "content"]:
+            return json_response(404, {"message": f"Unknown path {path}"})
+        parts = parts[3:]
+        with self.lock:
+            if not parts:
+                if method == "POST":
+                    parent = ((body or {}).get("ancestors") or [{}])[-1].get("id")
+                    page = self._create(
+                        body["title"], body["body"]["storage"]["value"], parent
+                    )
+                    return json_response(200, self.render(page))
+                matches = [
+                    self.render(page)
+                    for page in self.pages.values()
+                    if page["title"] == params.get("title")
+                ]
+                return json_response(200, {"results": matches, "size": len(matches)})
+            if parts[0] == "search":
+                cql = params.get("cql", "")
+                parent = (
+                    cql.split("parent=", 1)[-1].split()[0] if "parent=" in cql else None
+                )
+                results = self.children(parent)
+                return json_response(200, {"results": results, "size": len(results)})
+            page = self.pages.get(parts[0])
+            if page is None:
+                return json_response(404, {"message": f"No content with id {parts[0]}"})
+            if len(parts) == 1:
+                if method == "DELETE":
+                    for child in self.children(page["id"]):
+                        self.pages[child["id"]]["parent_id"] = page["parent_id"]
+                    del self.pages[page["id"]]
+                    return 204, {}, b""
+                if method == "PUT":
+                    page["title"] = body.get("title", page["title"])
+                    if body.get("body"):
+                        page["body"] = body["body"]["storage"]["value"]
+                    page["version"] = body.get("version", {}).get(
+                        "number", page["version"] + 1
+                    )
+                    return json_response(200, self.render(page))
+                return json_response(
+                    200, self.render(page, expand=params.get("expand", ""))
+                )
+            if parts[1] == "history":
+                return json_response(200, {"lastUpdated": {"number": page["version"]}})
+            if parts[1] == "child":
+                results = self.children(page["id"])
+                return json_response(
+                    200, {"results": results, "size": len(results), "_links": {}}
+                )
+            if parts[1] == "property":
+                key = parts[2] if len(parts) > 2 else (body or {}).get("key")
+                if method == "GET":
+                    if key not in page["properties"]:
+                        return json_response(404, {"message": f"No property {key}"})
+                    return json_response(200, page["properties"][key])
+                # Confluence numbers the versions of a property from 1
+                page["properties"][key] = {"version": {"number": 1}, **body}
+                return json_response(200, page["properties"][key])
+        return json_response(404, {"message": f"Unknown path {path}"})
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, with Nagle's algorithm on
+    # every keep-alive response would wait for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.handle_any("GET")
+
+    def do_POST(self):
+        self.handle_any("POST")
+
+    def do_PUT(self):
+        self.handle_any("PUT")
+
+    def do_PATCH(self):
+        self.handle_any("PATCH")
+
+    def do_DELETE(self):
+        self.handle_any("DELETE")
+
+    def handle_any(self, method):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_body = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw_body) if raw_body else None
+        except ValueError:
+            body = None
+        url = urlsplit(self.path)
+        family = url.path.strip("/").split("/", 1)[0]
+        status, headers, payload = self.server.respond(
+            method, family, url.path, url.query, body
+        )
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        exchanges,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        jitter=0.0,
+        throttle_rate=0.0,
+        retry_after=1.0,
+        seed=None,
+        verbose=False,
+    ):
+        super().__init__((host, port), ReplayHandler)
+        self.base_url = f"http://{host}:{self.server_address[1]}"
+        self.fixtures = FixtureStore(exchanges, self.base_url)
+        self.confluence = ConfluenceStore(self.fixtures.confluence_seed.values())
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.reset()
+
+    def url(self, family):
+        return f"{self.base_url}/{family}"
+
+    def reset(self):
+        # Back to the state right after loading, for repeated benchmark runs
+        self.fixtures.reset()
+        self.confluence.reset()
+        with self.lock:
+            self.stats = {"requests": {}, "throttled": 0, "unmatched": []}
+
+    def count(self, family):
+        with self.lock:
+            self.stats["requests"][family] = self.stats["requests"].get(family, 0) + 1
+
+    def throttle(self, family):
+        if family not in THROTTLED_FAMILIES or not self.throttle_rate:
+            return None
+        with self.lock:
+            if self.random.random() >= self.throttle_rate:
+                return None
+            self.stats["throttled"] += 1
+        return json_response(
+            429,
+            {"error": {"code": "TooManyRequests", "message": "Injected by replay"}},
+            {
+                "retry-after": str(max(int(self.retry_after), 1)),
+                "retry-after-ms": str(int(self.retry_after * 1000)),
+            },
+        )
+
+    def respond(self, method, family, path, query, body):
+        self.count(family)
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        throttled = self.throttle(family)
+        if throttled:
+            return throttled
+        if family == "confluence":
+            return self.confluence.handle(
+                method, path.removeprefix("/confluence"), query, body
+            )
+        if family == "graph" and path.endswith("/$batch"):
+            return self.batch(path.removesuffix("/$batch"), body)
+        return self.resolve(method, family, path, query, body)
+
+    def resolve(self, method, family, path, query, body):
+        if family == "graph" and path.lower().endswith("/directoryobjects/getbyids"):
+            return self.fixtures.get_by_ids(body)
+        response = self.fixtures.lookup(method, path, query, body)
+        if response:
+            return response
+        with self.lock:
+            self.stats["unmatched"].append(f"{method} {path}?{query}")
+        if self.verbose:
+            print(f"No recorded response for {method} {path}?{query}", file=sys.stderr)
+        return json_response(
+            404, {"error": {"code": "NotRecorded", "message": f"{method} {path}"}}
+        )
+
+    def batch(self, base_path, body):
+        responses = []
+        for request in (body or {}).get("requests", []):
+            url = urlsplit(request["url"])
+            status, headers, payload = self.throttle("graph") or self.resolve(
+                request.get("method", "GET"),
+                "graph",
+                base_path + url.path,
+                url.query,
+                request.get("body"),
+            )
+            responses.append(
+                {
+                    "id": request["id"],
+                    "status": status,
+                    "headers": headers,
+                    "body": json.loads(payload) if payload else None,
+                }
+            )
+        return json_response(200, {"responses": responses})
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="Replay Server",
+        description="Serve recorded or synthetic Graph, ARM and Confluence exchanges",
+    )
+    parser.add_argument("fixtures", nargs="+", help="JSONL exchange files")
+    parser.add_argument("-p", "--port", type=int, default=8765)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds added to every response"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Random extra latency, up to seconds"
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0.0,
+        help="Share of Graph and ARM requests answered with 429",
+    )
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server = ReplayServer(
+        load_exchanges(args.fixtures),
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        verbose=args.verbose,
+    )
+    for family in ("graph", "arm", "confluence"):
+        print(f"{family}: {server.url(family)}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+import argparse
+import importlib.util
+import json
+import random
+import sys
+import types
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+ROOT_PAGE_ID = "1000"
+GRAPH = "{graph}/v1.0"
+ARM = "{arm}"
+ENTRA_ROLES = [
+    "Global Administrator",
+    "Global Reader",
+    "Application Administrator",
+    "Helpdesk Administrator",
+    "Security Administrator",
+    "User Administrator",
+    "Reports Reader",
+    "Directory Readers",
+]
+AZURE_ROLES = ["Owner", "Contributor", "Reader", "User Access Administrator"]
+USER_TYPE = "#microsoft.graph.user"
+GROUP_TYPE = "#microsoft.graph.group"
+
+# Values for the creds module the jobs import, matching creds.py.example
+SYNTHETIC_CREDS = {
+    "azure_tenant_id": "00000000-0000-0000-0000-000000000000",
+    "azure_client_id": "00000000-0000-0000-0000-000000000001",
+    "azure_client_secret": "replay",
+    "azure_scope_exclusions": [],
+    "azure_subscription_exclusions": ["Developer"],
+    "azure_subscription_id_exclustions": [],
+    "confluence_token": "replay",
+    "confluence_url": "http://127.0.0.1/confluence",
+    "confluence_page_id": ROOT_PAGE_ID,
+    "confluence_entraid_page_name": "PIM: EntraID Rollen",
+    "confluence_azure_resource_page_name": "PIM: Azure Resource Rollen",
+    "confluence_audit_entraid_page_name": "Audit: EntraID Active Role Assignments",
+    "confluence_audit_azure_resources_page_name": "Audit: Azure Resources Active Role Assignments",
+}
+
+
+def install_creds(**overrides):
+    # The entry points import their settings from creds at import time
+    creds = types.ModuleType("creds")
+    creds.__dict__.update(SYNTHETIC_CREDS, **overrides)
+    sys.modules["creds"] = creds
+    return creds
+
+
+def exchange(method, url, body, request_body=None, status=200):
+    return {
+        "method": method,
+        "url": url,
+        "request": {"headers": {}, "body": request_body},
+        "status": status,
+        "headers": {"content-type": "application/json"},
+        "body": body,
+    }
+
+
+def paged(url, values, page_size, next_link_key="@odata.nextLink", last=None):
+    # A Graph collection split into pages linked by $skiptoken
+    pages = [values[i : i + page_size] for i in range(0, len(values), page_size)]
+    pages = pages or [[]]
+    for number, page in enumerate(pages):
+        page_url = url if number == 0 else f"{url.split('?')[0]}?$skiptoken={number}"
+        body = {"value": page}
+        if number + 1 < len(pages):
+            body[next_link_key] = f"{url.split('?')[0]}?$skiptoken={number + 1}"
+        elif last:
+            body.update(last)
+        yield exchange("GET", page_url, body)
+
+
+def resource_graph(query, rows, page_size):
+    pages = [rows[i : i + page_size] for i in range(0, len(rows), page_size)] or [[]]
+    for number, page in enumerate(pages):
+        options = {"$top": page_size, "resultFormat": "objectArray"}
+        if number:
+            options["$skipToken"] = f"page-{number}"
+        body = {
+            "totalRecords": len(rows),
+            "count": len(page),
+            "resultTruncated": "false",
+            "data": page,
+            "facets": [],
+        }
+        if number + 1 < len(pages):
+            body["$skipToken"] = f"page-{number + 1}"
+        yield exchange(
+            "POST",
+            f"{ARM}/providers/Microsoft.ResourceGraph/resources?api-version=2021-03-01",
+            body,
+            request_body={"query": query, "options": options},
+        )
+
+
+class SyntheticTenant:
+    # Users, nested groups, Entra ID roles and Azure subscriptions with
+    # eligible and active assignments, drawn from a seeded generator
+    def __init__(
+        self,
+        users=1000,
+        groups=100,
+        subscriptions=20,
+        depth=2,
+        members_per_group=25,
+        assignments_per_subscription=10,
+        seed=42,
+    ):
+        self.random = random.Random(seed)
+        self.users = [
+            {
+                "@odata.type": USER_TYPE,
+                "id": self.uuid(),
+                "displayName": f"User {number:05d}",
+                "userPrincipalName": f"user{number:05d}@contoso.example",
+            }
+            for number in range(users)
+        ]
+        self.groups = [
+            {
+                "@odata.type": GROUP_TYPE,
+                "id": self.uuid(),
+                "displayName": f"Group {number:04d}",
+            }
+            for number in range(groups)
+        ]
+        self.members = {
+            group["id"]: self.random.sample(
+                self.users, min(members_per_group, len(self.users))
+            )
+            for group in self.groups
+        }
+        # Groups are spread over the nesting levels, every group below the
+        # top level is a member of one group of the level above
+        levels = [self.groups[level::depth] for level in range(max(depth, 1))]
+        for upper, lower in zip(levels, levels[1:]):
+            for group in lower:
+                if upper:
+                    self.members[self.random.choice(upper)["id"]].append(group)
+        self.entra_roles = [
+            {
+                "id": self.uuid(),
+                "displayName": name,
+                "description": f"Synthetic {name}",
+                "isBuiltIn": True,
+                "isEnabled": True,
+                "resourceScopes": ["/"],
+            }
+            for name in ENTRA_ROLES
+        ]
+        self.subscriptions = [
+            {
+                "id": f"/subscriptions/{subscription_id}",
+                "subscriptionId": subscription_id,
+                "displayName": f"sub-{number:03d}-{self.random.choice(['prod', 'test', 'Developer'])}",
+                "state": "Enabled",
+                "tenantId": SYNTHETIC_CREDS["azure_tenant_id"],
+            }
+            for number, subscription_id in enumerate(
+                self.uuid() for _ in range(subscriptions)
+            )
+        ]
+        self.azure_roles = {
+            name: f"/providers/microsoft.authorization/roledefinitions/{self.uuid()}"
+            for name in AZURE_ROLES
+        }
+        self.assignments_per_subscription = assignments_per_subscription
+
+    def uuid(self):
+        return str(uuid.UUID(int=self.random.getrandbits(128)))
+
+    def principal(self):
+        return self.random.choice(
+            self.groups if self.random.random() < 0.6 else self.users
+        )
+
+    def entra_assignments(self, count):
+        for _ in range(count):
+            principal = self.principal()
+            role = self.random.choice(self.entra_roles)
+            yield {
+                "id": self.uuid(),
+                "principalId": principal["id"],
+                "roleDefinitionId": role["id"],
+                "directoryScopeId": "/",
+                "principal": principal,
+                "roleDefinition": {
+                    "id": role["id"],
+                    "displayName": role["displayName"],
+                },
+            }
+
+    def scopes(self, subscription):
+        yield subscription["id"]
+        for number in range(3):
+            yield f"{subscription['id']}/resourceGroups/rg-{number:02d}"
+
+    def azure_rows(self):
+        for subscription in self.subscriptions:
+            for _ in range(self.assignments_per_subscription):
+                principal = self.principal()
+                role_name = self.random.choice(AZURE_ROLES)
+                scope = self.random.choice(list(self.scopes(subscription)))
+                yield principal, role_name, self.azure_roles[role_name], scope
+
+    def exchanges(self, page_size=100):
+        # Imported late, the job modules read their settings from creds
+        if "creds" not in sys.modules and importlib.util.find_spec("creds") is None:
+            install_creds()
+        from functions.functions import RESOURCE_GRAPH_PAGE_SIZE, ROLE_ELIGIBILITY_QUERY
+        from Audit_Azure_Resources import ACTIVE_ASSIGNMENTS_QUERY
+
+        eligible = list(self.entra_assignments(len(self.users) // 5))
+        active = list(self.entra_assignments(len(self.users) // 5))
+        yield from paged(
+            f"{GRAPH}/roleManagement/directory/roleEligibilitySchedules",
+            eligible,
+            page_size,
+        )
+        yield from paged(
+            f"{GRAPH}/roleManagement/directory/roleAssignments", active, page_size
+        )
+        yield from paged(
+            f"{GRAPH}/roleManagement/directory/roleDefinitions",
+            self.entra_roles,
+            page_size,
+        )
+        yield from paged(
+            f"{GRAPH}/users/delta",
+            self.users,
+            page_size,
+            last={"@odata.deltaLink": f"{GRAPH}/users/delta?$deltatoken=replay"},
+        )
+        yield from paged(
+            f"{GRAPH}/groups/delta",
+            self.groups,
+            page_size,
+            last={"@odata.deltaLink": f"{GRAPH}/groups/delta?$deltatoken=replay"},
+        )
+        for group in self.groups:
+            yield from paged(
+                f"{GRAPH}/groups/{group['id']}/members",
+                self.members[group["id"]],
+                page_size,
+            )
+
+        yield exchange(
+            "GET",
+            f"{ARM}/subscriptions?api-version=2016-06-01",
+            {"value": self.subscriptions},
+        )
+        eligibility_rows = []
+        active_rows = []
+        for principal, role_name, role_id, scope in self.azure_rows():
+            principal_type = (
+                "Group" if principal["@odata.type"] == GROUP_TYPE else "User"
+            )
+            eligibility_rows.append(
+                {
+                    "principalId": principal["id"],
+                    "principalType": principal_type,
+                    "principalName": principal["displayName"],
+                    "roleDefinitionId": role_id,
+                    "roleName": role_name,
+                    "roleType": "BuiltInRole",
+                    "scope": scope,
+                    "scopeName": "",
+                    "scopeType": "",
+                    "memberType": "Direct",
+                }
+            )
+            active_rows.append(
+                {
+                    "principalId": principal["id"],
+                    "roleName": role_name,
+                    "roleDefinitionId": role_id,
+                    "scope": scope,
+                }
+            )
+        yield from resource_graph(
+            ROLE_ELIGIBILITY_QUERY, eligibility_rows, RESOURCE_GRAPH_PAGE_SIZE
+        )
+        yield from resource_graph(
+            ACTIVE_ASSIGNMENTS_QUERY, active_rows, RESOURCE_GRAPH_PAGE_SIZE
+        )
+
+        yield {
+            "confluence_page": {
+                "id": ROOT_PAGE_ID,
+                "title": "PIM Audit",
+                "body": "<p>Synthetic root page</p>",
+                "parent_id": None,
+            }
+        }
+
+
+def write_fixture(path, tenant, page_size=100):
+    count = 0
+    with open(path, "w") as fixture:
+        for item in tenant.exchanges(page_size=page_size):
+            fixture.write(json.dumps(item) + "\n")
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="Synthetic Tenant",
+        description="Generate replay fixtures for a synthetic tenant of a given size",
+    )
+    parser.add_argument("output", help="JSONL file to write the exchanges to")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--subscriptions", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=2, help="Group nesting levels")
+    parser.add_argument("--members-per-group", type=int, default=25)
+    parser.add_argument("--assignments-per-subscription", type=int, default=10)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    tenant = SyntheticTenant(
+        users=args.users,
+        groups=args.groups,
+        subscriptions=args.subscriptions,
+        depth=args.depth,
+        members_per_group=args.members_per_group,
+        assignments_per_subscription=args.assignments_per_subscription,
+        seed=args.seed,
+    )
+    count = write_fixture(args.output, tenant, page_size=args.page_size)
+    print(f"Wrote {count} exchanges to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
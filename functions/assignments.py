@@ -0,0 +1,67 @@
+import sys
+from collections import namedtuple
+
+# One row per principal, role definition and scope, all stored as object IDs
+Assignment = namedtuple("Assignment", ["principal_id", "role_id", "scope_id"])
+
+# Table column -> Assignment field whose display name fills it
+COLUMNS = {"Benutzer": "principal_id", "Rolle": "role_id", "Scope": "scope_id"}
+
+
+def make_assignment(principal_id, role_id, scope_id=""):
+    # IDs repeat on thousands of rows, interning keeps one copy of each and
+    # makes comparisons identity checks
+    return Assignment(
+        sys.intern(str(principal_id)),
+        sys.intern(str(role_id).lower()),
+        sys.intern(str(scope_id or "")),
+    )
+
+
+class AssignmentTable:
+    # Set of assignments plus one display name per ID, names are only used
+    # when the table is rendered
+    def __init__(self):
+        self.assignments = set()
+        self.names = {}
+
+    def add(
+        self,
+        principal_id,
+        principal_name,
+        role_id,
+        role_name,
+        scope_id="",
+        scope_name="",
+    ):
+        assignment = make_assignment(principal_id, role_id, scope_id)
+        self.assignments.add(assignment)
+        for object_id, name in zip(assignment, (principal_name, role_name, scope_name)):
+            if object_id not in self.names:
+                self.names[object_id] = name or object_id
+        return assignment
+
+    def name(self, object_id):
+        return self.names.get(object_id, object_id)
+
+    def __contains__(self, assignment):
+        return assignment in self.assignments
+
+    def __iter__(self):
+        return iter(self.assignments)
+
+    def __len__(self):
+        return len(self.assignments)
+
+    def render(self, columns=("Benutzer", "Rolle", "Scope"), assignments=None):
+        # Rows sorted by their display names in column order
+        fields = [COLUMNS[column] for column in columns]
+        rows = [
+            {
+                column: self.name(getattr(assignment, field))
+                for column, field in zip(columns, fields)
+            }
+            for assignment in (self.assignments if assignments is None else assignments)
+        ]
+        rows.sort(key=lambda row: tuple(row[column] for column in columns))
+        return rows
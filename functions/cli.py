@@ -0,0 +1,106 @@
+def add_common_arguments(parser):
+    parser.add_argument(
+        "-t",
+        "--test",
+        help="Dryrun the script without writing to Confluence",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        help="Maximum number of concurrent Graph requests",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--cache-file",
+        help="SQLite file to share the group membership cache between runs",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        help="Seconds a cached group membership stays valid",
+        type=int,
+        default=3600,
+    )
+    parser.add_argument(
+        "--transitive",
+        help="Resolve nested groups into their user members",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--snapshot-db",
+        help="SQLite file that keeps a daily snapshot of the collected assignments",
+        default=None,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Directory to write a span trace and cProfile output of the run to",
+        default=None,
+    )
+    parser.add_argument(
+        "--record",
+        help="Directory to record the API exchanges of the run to. Tokens and "
+        "secrets are removed, names, addresses and IDs are pseudonymized",
+        default=None,
+    )
+    parser.add_argument(
+        "--record-raw",
+        help="Keep names, addresses and IDs in the recording unchanged. The "
+        "recording then contains directory PII and must not leave the machine",
+        action="store_true",
+    )
+    return parser
+
+
+def instrumentation_options(args):
+    return {
+        "profile": args.profile,
+        "record": args.record,
+        "pseudonymize": not args.record_raw,
+    }
+
+
+def add_azure_arguments(parser):
+    parser.add_argument(
+        "-w",
+        "--subscription-workers",
+        help="Number of subscriptions queried in parallel",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "-e",
+        "--eligibility-source",
+        help="Collect role eligibilities per subscription via ARM or from Resource Graph. "
+        "Resource Graph only covers the subscriptions themselves, eligibilities "
+        "inherited from management groups are missing",
+        choices=["arm", "resourcegraph"],
+        default="arm",
+    )
+    return parser
+
+
+def shard_option(value):
+    if value in ("initial", "subscription"):
+        return value
+    return int(value)
+
+
+def add_sharding_arguments(parser):
+    parser.add_argument(
+        "--shard-by",
+        help="Split the audit table across child pages by user initial, by subscription or every N rows",
+        type=shard_option,
+        default=None,
+    )
+    return parser
+
+
+def graph_client_options(args):
+    return {
+        "max_concurrency": args.concurrency,
+        "cache_path": args.cache_file,
+        "cache_ttl": args.cache_ttl,
+        "transitive": args.transitive,
+    }
@@ -1,8 +1,96 @@
-import pandas as pd
+import asyncio
 import datetime
+import hashlib
+import threading
 from datetime import datetime
-from atlassian import Confluence
+from html import escape as escape_html
+from html.entities import name2codepoint
+from io import BytesIO
+from requests import Session
+from requests.adapters import HTTPAdapter
 import json
+import re
+from kestra import Kestra
+from functions.instrumentation import instrumentation
+
+logger = Kestra.logger()
+
+# atlassian and lxml are imported on first use, both add noticeably to the
+# startup of every script
+
+# Page property holding the hash of the content last written by these scripts
+CONTENT_HASH_PROPERTY = "pim-audit-content-hash"
+
+# Index page of a sharded table, Confluence lists the shard pages by itself
+SHARD_INDEX_BODY = '<ac:structured-macro ac:name="children"/>'
+SHARD_SUBSCRIPTION_PATTERN = re.compile(r"^/subscriptions/([^/]+)", re.IGNORECASE)
+
+# Prefixes used in the storage format, declared on a wrapping root element so
+# the page parses as XML and CDATA macro bodies survive a round trip
+STORAGE_NAMESPACES = {
+    "ac": "http://atlassian.com/content",
+    "ri": "http://atlassian.com/resource/identifier",
+    "at": "http://atlassian.com/template",
+}
+STORAGE_ROOT = "<storage-root %s>" % " ".join(
+    f'xmlns:{prefix}="{uri}"' for prefix, uri in STORAGE_NAMESPACES.items()
+)
+STORAGE_NAMESPACE_DECLARATIONS = re.compile(
+    ' xmlns:(?:%s)="[^"]*"' % "|".join(STORAGE_NAMESPACES)
+)
+# Named HTML entities other than the XML ones, the XML parser does not know them
+HTML_ENTITY = re.compile(r"&(?!(?:amp|lt|gt|quot|apos);)([A-Za-z][A-Za-z0-9]*);")
+
+
+class ConfluenceClient:
+    # atlassian.Confluence on a pooled session that remembers child page
+    # listings for the whole run, the async methods run the blocking calls
+    # in worker threads so they overlap with the Graph and ARM requests
+    def __init__(self, url=None, token=None, pool_size=10):
+        session = Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.hooks = instrumentation.requests_hooks()
+        if url:
+            instrumentation.add_host(url, "{confluence}")
+        from atlassian import Confluence
+
+        self.confluence = Confluence(url=url, token=token, session=session)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.confluence, name)
+
+    def get_page_child_by_type(self, page_id, type="page"):
+        with self.lock:
+            children = self.children.get((page_id, type))
+        if children is None:
+            children = list(self.confluence.get_page_child_by_type(page_id, type=type))
+            with self.lock:
+                self.children[(page_id, type)] = children
+        return children
+
+    def update_or_create(self, parent_id, title, body, **kwargs):
+        page = self.confluence.update_or_create(parent_id, title, body, **kwargs)
+        with self.lock:
+            self.children.pop((parent_id, "page"), None)
+        return page
+
+    def remove_page(self, page_id, **kwargs):
+        result = self.confluence.remove_page(page_id, **kwargs)
+        with self.lock:
+            self.children.clear()
+        return result
+
+    async def run(self, function, *args, **kwargs):
+        return await asyncio.to_thread(function, self, *args, **kwargs)
+
+    async def publish(self, **kwargs):
+        return await asyncio.to_thread(
+            confluence_update_page, confluence=self, **kwargs
+        )
 
 
 def bulletpointer(data):
@@ -13,13 +101,115 @@ def bulletpointer(data):
     return back
 
 
-def convert_to_html_table(data=None, escape=True, transpose_table=False):
-    df = pd.DataFrame(data)
+class StorageMarkup(str):
+    # Cell content that already is storage format and is written back as is
+    pass
+
+
+def table_columns(data):
+    # Union of all keys in first-seen order, the same order pandas would use
+    return list(dict.fromkeys(key for row in data for key in row))
+
+
+def format_cell(value, escape=True):
+    if value is None:
+        return ""
+    if isinstance(value, StorageMarkup):
+        return value
+    value = str(value)
+    if escape:
+        return escape_html(value, quote=False)
+    return value
+
+
+def iter_table_rows(data, columns, transpose_table=False):
+    # Yields the header followed by the body rows as lists of raw values
     if transpose_table:
-        html_table = df.T.to_html(index=False, escape=escape)
+        # Like DataFrame.T.to_html(index=False): one row per column and the
+        # row positions as the header
+        data = list(data)
+        yield list(range(len(data)))
+        for column in columns:
+            yield [row.get(column) for row in data]
+        return
+    yield columns
+    for row in data:
+        yield [row.get(column) for column in columns]
+
+
+def iter_html_table(
+    data=None, escape=True, transpose_table=False, columns=None, expand_title=None
+):
+    # Streams the table as storage format chunks without building a DataFrame,
+    # pass columns to avoid a pass over data when it is a generator
+    if columns is None:
+        data = list(data)
+        columns = table_columns(data)
+    if expand_title:
+        yield '<ac:structured-macro ac:name="expand">'
+        yield f'<ac:parameter ac:name="title">{escape_html(expand_title)}</ac:parameter>'
+        yield "<ac:rich-text-body>"
+    rows = iter_table_rows(data, columns, transpose_table=transpose_table)
+    yield "<table><thead><tr>"
+    for value in next(rows):
+        yield f"<th>{format_cell(value, escape)}</th>"
+    yield "</tr></thead><tbody>"
+    for row in rows:
+        yield "<tr>"
+        yield "".join(f"<td>{format_cell(value, escape)}</td>" for value in row)
+        yield "</tr>"
+    yield "</tbody></table>"
+    if expand_title:
+        yield "</ac:rich-text-body></ac:structured-macro>"
+
+
+def convert_to_html_table(
+    data=None, escape=True, transpose_table=False, expand_title=None
+):
+    return "".join(
+        iter_html_table(
+            data,
+            escape=escape,
+            transpose_table=transpose_table,
+            expand_title=expand_title,
+        )
+    )
+
+
+def content_hash(**content):
+    # Stable over dict key order, so only real content changes alter the hash
+    normalized = json.dumps(content, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def get_content_hash(confluence=None, page_id=None):
+    # Returns ({"hash", "page_version"}, property version). Values written
+    # before the page version was stored along count as unknown.
+    try:
+        page_property = confluence.get_page_property(page_id, CONTENT_HASH_PROPERTY)
+    except Exception:
+        return None, None
+    if not page_property or "value" not in page_property:
+        return None, None
+    value = page_property["value"]
+    if not isinstance(value, dict):
+        value = None
+    return value, page_property["version"]["number"]
+
+
+def get_page_version(confluence=None, page_id=None, page=None):
+    if not page or "version" not in page:
+        page = confluence.get_page_by_id(page_id, expand="version")
+    return page["version"]["number"]
+
+
+def set_content_hash(confluence=None, page_id=None, value=None, version=None):
+    data = {"key": CONTENT_HASH_PROPERTY, "value": value}
+    if version:
+        data["version"] = {"number": version + 1}
+        confluence.update_page_property(page_id, data)
     else:
-        html_table = df.to_html(index=False, escape=escape)
-    return html_table
+        confluence.set_page_property(page_id, data)
 
 
 def confluence_update_page(
@@ -34,30 +224,74 @@ def confluence_update_page(
     escape_table=True,
     transpose_table=False,
     toc=False,
+    expand_title=None,
+    shard_by=None,
+    confluence_page_id=None,
 ):
 
-    if toc:
-        body = '<ac:structured-macro ac:name="toc"/>'
-    else:
-        body = ""
-
-    if body_header:
-        body += body_header
+    # A sharded report stays sharded when it is empty, otherwise the index
+    # page would turn into a bare table next to the old shard pages
+    if confluence and title and parent_id and shard_by:
+        return confluence_update_sharded_page(
+            title=title,
+            parent_id=parent_id,
+            table=table,
+            shard_by=shard_by,
+            representation=representation,
+            full_width=full_width,
+            confluence=confluence,
+            body_header=body_header,
+            body_footer=body_footer,
+            escape_table=escape_table,
+            transpose_table=transpose_table,
+            expand_title=expand_title,
+        )
     if confluence and title and parent_id:
-        children = confluence.get_page_child_by_type(parent_id, type="page")
-        confluence_page_id = None
-        for child in children:
-            if child["title"] == title:
-                confluence_page_id = child["id"]
+        if not confluence_page_id:
+            confluence_page_id = get_childid(confluence, parent_id, title)
+
+        # Skip rendering and uploading when the page already has this content
+        new_hash = content_hash(
+            table=table,
+            body_header=body_header,
+            body_footer=body_footer,
+            escape_table=escape_table,
+            transpose_table=transpose_table,
+            toc=toc,
+            expand_title=expand_title,
+        )
+        stored, hash_version = None, None
+        if confluence_page_id:
+            stored, hash_version = get_content_hash(confluence, confluence_page_id)
+        # A newer page version than the one written with the hash means the
+        # page was edited by hand, the generated content has to be restored
+        if (
+            stored
+            and stored.get("hash") == new_hash
+            and stored.get("page_version")
+            == get_page_version(confluence, confluence_page_id)
+        ):
+            logger.info(f"Confluence page {title} is unchanged, skipping update")
+            return confluence_page_id
+
+        if toc:
+            body = '<ac:structured-macro ac:name="toc"/>'
+        else:
+            body = ""
+        if body_header:
+            body += body_header
         if table:
             table = convert_to_html_table(
-                data=table, escape=escape_table, transpose_table=transpose_table
+                data=table,
+                escape=escape_table,
+                transpose_table=transpose_table,
+                expand_title=expand_title,
             )
             body += table
         if body_footer:
             body += body_footer
         if confluence_page_id:
-            confluence.update_page(
+            page = confluence.update_page(
                 confluence_page_id,
                 title,
                 body,
@@ -67,13 +301,24 @@ def confluence_update_page(
                 minor_edit=True,
             )
         else:
-            confluence.update_or_create(
+            page = confluence.update_or_create(
                 parent_id,
                 title,
                 body,
                 representation=representation,
                 full_width=full_width,
             )
+            confluence_page_id = page["id"]
+        set_content_hash(
+            confluence,
+            confluence_page_id,
+            {
+                "hash": new_hash,
+                "page_version": get_page_version(confluence, confluence_page_id, page),
+            },
+            hash_version,
+        )
+        return confluence_page_id
     else:
         print("Missing confluence parameters")
         print("title:", title)
@@ -83,6 +328,82 @@ def confluence_update_page(
         return False
 
 
+def shard_key(mapping, shard_by):
+    if shard_by == "subscription":
+        match = SHARD_SUBSCRIPTION_PATTERN.match(mapping.get("Scope") or "")
+        return match.group(1) if match else "Andere"
+    initial = (mapping.get("Benutzer") or "#")[:1].upper()
+    return initial if initial.isalpha() else "#"
+
+
+def shard_table(table, shard_by):
+    # Splits the rows into {shard name: rows}, by user initial, by the
+    # subscription in the scope or into chunks of a fixed number of rows
+    shards = {}
+    if isinstance(shard_by, int):
+        for start in range(0, len(table), shard_by):
+            rows = table[start : start + shard_by]
+            shards[f"{start + 1}-{start + len(rows)}"] = rows
+        return shards
+    for mapping in table:
+        shards.setdefault(shard_key(mapping, shard_by), []).append(mapping)
+    return dict(sorted(shards.items()))
+
+
+def confluence_update_sharded_page(
+    title=None,
+    parent_id=None,
+    table=None,
+    shard_by=None,
+    representation="storage",
+    full_width=False,
+    confluence=None,
+    body_header=None,
+    body_footer=None,
+    escape_table=True,
+    transpose_table=False,
+    expand_title=None,
+):
+    # The page itself becomes an index, the table goes to one child page per
+    # shard and only shards whose content changed are written
+    index_page_id = confluence_update_page(
+        title=title,
+        parent_id=parent_id,
+        representation=representation,
+        full_width=full_width,
+        confluence=confluence,
+        body_header=(body_header or "") + SHARD_INDEX_BODY,
+        body_footer=body_footer,
+    )
+    shard_prefix = f"{title} - "
+    shard_pages = {
+        child["title"]: child["id"]
+        for child in confluence.get_page_child_by_type(index_page_id, type="page")
+        if child["title"].startswith(shard_prefix)
+    }
+    shards = shard_table(table or [], shard_by)
+    for name, rows in shards.items():
+        shard_title = f"{shard_prefix}{name}"
+        confluence_update_page(
+            title=shard_title,
+            parent_id=index_page_id,
+            table=rows,
+            representation=representation,
+            full_width=full_width,
+            confluence=confluence,
+            escape_table=escape_table,
+            transpose_table=transpose_table,
+            expand_title=expand_title,
+            confluence_page_id=shard_pages.pop(shard_title, None),
+        )
+    # Whatever is left belongs to shards that no longer have rows
+    for shard_title, shard_page_id in shard_pages.items():
+        logger.info(f"Removing stale shard {shard_title}")
+        confluence.remove_page(shard_page_id, status=None, recursive=False)
+    logger.info(f"Confluence page {title} split into {len(shards)} shards")
+    return index_page_id
+
+
 def style_text(text, bold=False, italic=False, underline=False, color=None, h=None):
     if color and (color.lower() == "good" or color.lower() == "green"):
         text = f'<span style="color: rgb(4, 138, 26);">{text}</span>'
@@ -102,6 +423,8 @@ def style_text(text, bold=False, italic=False, underline=False, color=None, h=No
 def cleanup_children(
     confluence_url, confluence_token, confluence_page_id, sub_page_name=None
 ):
+    from atlassian import Confluence
+
     confluence = Confluence(url=confluence_url, token=confluence_token)
     if sub_page_name:
         children = confluence.get_page_child_by_type(confluence_page_id, type="page")
@@ -125,3 +448,98 @@ def get_childid(confluence=None, confluence_page_id=None, sub_page_name=None):
 def get_tables(confluence=None, confluence_page_id=None):
     tables = confluence.get_tables_from_page(confluence_page_id)
     return json.loads(tables)
+
+
+def get_page_storage(confluence=None, confluence_page_id=None):
+    page = confluence.get_page_by_id(confluence_page_id, expand="body.storage")
+    return page["body"]["storage"]["value"]
+
+
+def resolve_html_entities(storage):
+    def replace(match):
+        codepoint = name2codepoint.get(match.group(1))
+        return f"&#{codepoint};" if codepoint else match.group(0)
+
+    return HTML_ENTITY.sub(replace, storage)
+
+
+def iter_storage_rows(storage):
+    # Rows of the top level tables as (table number, cells), rows are dropped
+    # once consumed so large pages are never held as a full tree
+    if not storage or not storage.strip():
+        # lxml refuses an empty document, a blank page simply has no rows
+        return
+    from lxml import etree
+
+    depth = 0
+    table_number = -1
+    document = f"{STORAGE_ROOT}{resolve_html_entities(storage)}</storage-root>"
+    events = etree.iterparse(
+        BytesIO(document.encode("utf-8")),
+        events=("start", "end"),
+        strip_cdata=False,
+        resolve_entities=False,
+        huge_tree=True,
+    )
+    for event, element in events:
+        if element.tag == "table":
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    table_number += 1
+            else:
+                depth -= 1
+        elif event == "end" and element.tag == "tr" and depth == 1:
+            yield table_number, [cell for cell in element if cell.tag in ("th", "td")]
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+def cell_text(cell):
+    return "".join(cell.itertext()).strip()
+
+
+def cell_markup(cell):
+    from lxml import etree
+
+    markup = escape_html(cell.text or "", quote=False)
+    for child in cell:
+        # lxml repeats the namespace declarations of the root on every child
+        markup += STORAGE_NAMESPACE_DECLARATIONS.sub(
+            "", etree.tostring(child, encoding="unicode")
+        )
+    return StorageMarkup(markup)
+
+
+def iter_table_mappings(rows, table_number, headers, text_columns):
+    for number, cells in rows:
+        if number != table_number:
+            break
+        mapping = {}
+        for header, cell in zip(headers, cells):
+            if header in text_columns:
+                mapping[header] = cell_text(cell)
+            else:
+                mapping[header] = cell_markup(cell)
+        for header in headers[len(cells) :]:
+            mapping[header] = ""
+        yield mapping
+
+
+def read_storage_table(storage, signature=(), text_columns=()):
+    # Finds the first table whose header contains all signature columns and
+    # returns its headers and a lazy iterator over the rows. Only the
+    # text_columns are flattened, other cells keep their markup.
+    rows = iter_storage_rows(storage)
+    current_table = None
+    for table_number, cells in rows:
+        if table_number == current_table:
+            continue
+        current_table = table_number
+        headers = [cell_text(cell) for cell in cells]
+        if set(signature) <= set(headers):
+            return headers, iter_table_mappings(
+                rows, table_number, headers, text_columns
+            )
+    return [], iter(())
@@ -0,0 +1,118 @@
+import asyncio
+import functools
+from kestra import Kestra
+from functions.functions import (
+    get_assignments,
+    get_azure_subscriptions,
+    collect_group_eligibilities,
+    iter_azure_resource_role_assignments,
+    iter_azure_resource_role_eligibilities_from_resource_graph,
+    ResourceGraphTruncatedError,
+)
+
+logger = Kestra.logger()
+
+
+class RunDatasets:
+    # Every dataset is fetched at most once per run, concurrent callers
+    # await the same task
+    def __init__(self, graph_client=None, credential=None):
+        self.graph_client = graph_client
+        self._credential = credential
+        self.tasks = {}
+
+    @functools.cached_property
+    def credential(self):
+        # Built on first use, Entra ID only runs never need the ARM credential
+        if self._credential:
+            return self._credential
+        from azure.identity import ClientSecretCredential
+
+        return ClientSecretCredential(
+            self.graph_client.azure_tenant_id,
+            self.graph_client.azure_client_id,
+            self.graph_client.azure_client_secret,
+        )
+
+    def _load(self, name, factory, *args, **kwargs):
+        if name not in self.tasks:
+            logger.debug(f"Loading dataset {name}")
+            self.tasks[name] = asyncio.ensure_future(factory(*args, **kwargs))
+        return self.tasks[name]
+
+    async def entraid_roles(self):
+        return await self._load("entraid_roles", self.graph_client.get_entraid_roles)
+
+    async def entraid_role_assignments(self):
+        return await self._load(
+            "entraid_role_assignments", self.graph_client.get_entraid_role_assignments
+        )
+
+    async def entraid_eligibility(self):
+        return await self._load(
+            "entraid_eligibility", get_assignments, self.graph_client
+        )
+
+    async def user_display_names(self):
+        return await self._load(
+            "user_display_names", self.graph_client.get_user_display_names
+        )
+
+    async def azure_subscriptions(self):
+        return await self._load(
+            "azure_subscriptions",
+            asyncio.to_thread,
+            get_azure_subscriptions,
+            credential=self.credential,
+            dict=True,  # filters=["-v-", "_v_"], starts_with=["p-", "t-"]
+        )
+
+    async def azure_eligibility(self, source="arm", max_workers=8):
+        # (group IDs, sorted group eligibilities, failed subscription IDs), the
+        # eligibilities are streamed from disk on every iteration
+        return await self._load(
+            "azure_eligibility", self._load_azure_eligibility, source, max_workers
+        )
+
+    async def _load_azure_eligibility(self, source, max_workers):
+        subscription_dict = await self.azure_subscriptions()
+        subscriptions = list(subscription_dict)
+        group_eligibilities = []
+        failed_subscriptions = []
+        if source == "resourcegraph":
+            try:
+                group_ids, group_eligibilities = await asyncio.to_thread(
+                    collect_group_eligibilities,
+                    iter_azure_resource_role_eligibilities_from_resource_graph(
+                        subscriptions,
+                        self.credential,
+                        subscription_dict=subscription_dict,
+                    ),
+                )
+            except ResourceGraphTruncatedError as e:
+                # A partial result would mark every later row as removed
+                logger.warning(f"{e}, falling back to ARM")
+                group_eligibilities = []
+            else:
+                if not group_eligibilities and subscriptions:
+                    # An empty result would wipe the documentation, so double check via ARM
+                    logger.warning(
+                        "Resource Graph returned no eligibilities, falling back to ARM"
+                    )
+        if not group_eligibilities:
+            group_ids, group_eligibilities = await asyncio.to_thread(
+                collect_group_eligibilities,
+                iter_azure_resource_role_assignments(
+                    subscriptions,
+                    self.credential,
+                    max_workers=max_workers,
+                    failed_subscriptions=failed_subscriptions,
+                ),
+            )
+        return group_ids, group_eligibilities, failed_subscriptions
+
+    async def prefetch(self, names, **kwargs):
+        # Start the given datasets side by side and wait for all of them
+        await asyncio.gather(
+            *(getattr(self, name)(**kwargs.get(name, {})) for name in names)
+        )
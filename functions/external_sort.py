@@ -0,0 +1,87 @@
+import heapq
+import pickle
+import tempfile
+from kestra import Kestra
+
+logger = Kestra.logger()
+
+# Items held in memory before a sorted run is written to disk
+EXTERNAL_SORT_CHUNK_SIZE = 100_000
+# Items pickled together, one pickle per item would dominate the runtime
+EXTERNAL_SORT_BLOCK_SIZE = 1_000
+
+
+def unique_sorted(items):
+    # Drops consecutive duplicates from an already sorted iterable
+    previous = None
+    first = True
+    for item in items:
+        if first or item != previous:
+            yield item
+        previous = item
+        first = False
+
+
+def read_run(run):
+    while True:
+        try:
+            block = pickle.load(run)
+        except EOFError:
+            return
+        yield from block
+
+
+class ExternalSorter:
+    # Collects tuples, sorts and deduplicates them in chunks that are spilled
+    # to temporary files and merges the chunks lazily when iterated. Every
+    # iteration starts from the beginning, close() releases the files.
+    def __init__(self, chunk_size=EXTERNAL_SORT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.runs = []
+        self.count = 0
+
+    def add(self, item):
+        self.buffer.append(item)
+        self.count += 1
+        if len(self.buffer) >= self.chunk_size:
+            self._spill()
+
+    def extend(self, items):
+        for item in items:
+            self.add(item)
+
+    def _spill(self):
+        self.buffer.sort()
+        run = tempfile.TemporaryFile()
+        block = []
+        for item in unique_sorted(self.buffer):
+            block.append(item)
+            if len(block) >= EXTERNAL_SORT_BLOCK_SIZE:
+                pickle.dump(block, run, protocol=pickle.HIGHEST_PROTOCOL)
+                block = []
+        if block:
+            pickle.dump(block, run, protocol=pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self.runs.append(run)
+        self.buffer = []
+        logger.debug(f"Spilled sorted run {len(self.runs)} to disk")
+
+    def __len__(self):
+        # Number of items added, before deduplication
+        return self.count
+
+    def __iter__(self):
+        self.buffer.sort()
+        for run in self.runs:
+            run.seek(0)
+        streams = [read_run(run) for run in self.runs]
+        streams.append(iter(self.buffer))
+        yield from unique_sorted(heapq.merge(*streams))
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.buffer = []
+        self.count = 0
@@ -1,122 +1,157 @@
 import json
+import sys
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
 from kestra import Kestra
 
 logger = Kestra.logger()
 # from functions.log_config import logger
-from azure.mgmt.authorization import AuthorizationManagementClient
-from azure.mgmt.subscription import SubscriptionClient
-from msgraph.generated.models.group import Group
+
+# The Azure SDK clients are imported where they are built, so scripts that
+# never talk to ARM do not pay for them at startup
+from functions.msgraphapi import GROUP_ODATA_TYPE
+from functions.scopes import ScopeResolver
+from functions.assignments import AssignmentTable, make_assignment
+from functions.external_sort import EXTERNAL_SORT_CHUNK_SIZE, ExternalSorter
+from functions.throttling import scheduler
+from functions.instrumentation import instrumentation
 from functions.confluence import (
     confluence_update_page,
     style_text,
     get_childid,
     convert_to_html_table,
-    get_tables,
+    get_page_storage,
+    read_storage_table,
 )
 
 
 async def get_assignments(pim):
-    assignment_dict = {}
+    assignment_table = AssignmentTable()
     assignments = await pim.get_role_eligibility_schedules()
 
+    # Expand all assigned groups up front instead of one request per assignment
+    group_ids = [
+        assignment.principal.id
+        for assignment in assignments
+        if assignment.principal.odata_type == GROUP_ODATA_TYPE
+    ]
+    members_by_group = await pim.get_members_of_groups(group_ids)
+
     for assignment in assignments:
         principal = assignment.principal
-        role = assignment.role_definition.display_name
-        principal_display_name = assignment.principal.display_name
-        if isinstance(assignment.principal, Group):
-            logger.debug(f"Group: {principal_display_name} is assigned to {role}")
-            group_id = principal.id
-            group_members = await pim.get_group_members(group_id)
-            if len(group_members) > 0:
-                for group_member in group_members:
-                    member_display_name = group_member.display_name
-                    if role not in assignment_dict:
-                        assignment_dict[role] = [member_display_name]
-                    else:
-                        assignment_dict[role].append(member_display_name)
+        role = assignment.role_definition
+        if principal.odata_type == GROUP_ODATA_TYPE:
+            logger.debug(
+                f"Group: {principal.display_name} is assigned to {role.display_name}"
+            )
+            principals = members_by_group[principal.id]
         else:
-            if role not in assignment_dict:
-                assignment_dict[role] = [principal_display_name]
-            else:
-                assignment_dict[role].append(principal_display_name)
-    return assignment_dict
-
+            principals = [principal]
+        for member in principals:
+            assignment_table.add(
+                member.id, member.display_name, role.id, role.display_name
+            )
+    return assignment_table
 
-def build_user_array(assignment_dict):
-    user_roles = {}
-    for role in assignment_dict:
-        if privileged_role_filter(role):
-            for user in assignment_dict[role]:
-                if user not in user_roles:
-                    user_roles[user] = [role]
-                else:
-                    user_roles[user].append(role)
 
-    user_array = []
-    for user in user_roles:
-        for role in user_roles[user]:
-            user_array.append({"Benutzer": user, "Rolle": role})
-    return user_array
+def build_user_array(assignment_table):
+    return assignment_table.render(
+        columns=("Benutzer", "Rolle"),
+        assignments=(
+            assignment
+            for assignment in assignment_table
+            if privileged_role_filter(assignment_table.name(assignment.role_id))
+        ),
+    )
 
 
-def get_documented_mappings(confluence, confluence_page_id, sub_page_name):
+def get_documented_mappings(
+    confluence, confluence_page_id, sub_page_name, keys=("Benutzer", "Rolle")
+):
     export_page_id = get_childid(confluence, confluence_page_id, sub_page_name)
     if export_page_id:
-        tables = get_tables(confluence, export_page_id)
-        existing_role_mappings = tables["tables_content"][0]
-
-        # Extract headers
-        headers = existing_role_mappings[0]
-        # Convert rows to dictionaries
-        role_mappings = [dict(zip(headers, row)) for row in existing_role_mappings[1:]]
+        storage = get_page_storage(confluence, export_page_id)
+        # The key columns are compared as text, the manually maintained
+        # columns keep their formatting when the page is written back
+        headers, role_mappings = read_storage_table(
+            storage, signature=keys, text_columns=keys
+        )
     else:
         role_mappings = []
         headers = []
     return role_mappings, headers
 
 
-def check_new_mappings(user_array, role_mappings, headers):
-    changes = []
-    for exported_role in user_array:
-        mapped = False
-        for existing_mapping in role_mappings:
-            if (
-                exported_role["Benutzer"] == existing_mapping["Benutzer"]
-                and exported_role["Rolle"] == existing_mapping["Rolle"]
-            ):
-                mapped = True
-                break
-        if not mapped:
+def load_documented_mappings(
+    confluence, confluence_page_id, sub_page_name, keys=("Benutzer", "Rolle")
+):
+    # Parses the whole table, meant to run in a worker thread next to the
+    # data collection
+    role_mappings, headers = get_documented_mappings(
+        confluence, confluence_page_id, sub_page_name, keys=keys
+    )
+    return list(role_mappings), headers
+
+
+def mapping_key(mapping, keys):
+    return tuple(mapping[key] for key in keys)
+
+
+def index_mappings(mappings, keys):
+    # First occurrence wins, later duplicates are dropped
+    index = {}
+    for mapping in mappings:
+        index.setdefault(mapping_key(mapping, keys), mapping)
+    return index
+
+
+def diff_mappings(
+    current_mappings=[], documented_mappings=[], keys=("Benutzer", "Rolle"), headers=[]
+):
+    current_index = index_mappings(current_mappings, keys)
+    documented_keys = set()
+    removed = []
+    unchanged = []
+    for mapping in documented_mappings:
+        key = mapping_key(mapping, keys)
+        documented_keys.add(key)
+        if key in current_index:
+            unchanged.append(mapping)
+        else:
+            logger.debug(f"Removed mapping: {mapping}")
+            removed.append(mapping)
+
+    added = []
+    for key, mapping in current_index.items():
+        if key not in documented_keys:
+            # Keep the manually maintained Confluence columns
             for header in headers:
-                if header not in exported_role:
-                    exported_role[header] = ""
-            print(f"New mapping: {exported_role}")
-            role_mappings.append(exported_role)
-            changes.append(exported_role)
+                if header not in mapping:
+                    mapping[header] = ""
+            logger.debug(f"New mapping: {mapping}")
+            added.append(mapping)
+    return added, removed, unchanged
+
+
+def check_new_mappings(user_array, role_mappings, headers):
+    changes, _, _ = diff_mappings(
+        current_mappings=user_array, documented_mappings=role_mappings, headers=headers
+    )
+    role_mappings.extend(changes)
     if len(changes) < 1:
         changes = False
     return role_mappings, changes
 
 
 def check_removed_mappings(user_array, role_mappings):
-    changes = []
-
-    # Collect mappings to be removed
-    for existing_mapping in [mapping for mapping in role_mappings]:
-        if not any(
-            exported_role["Benutzer"] == existing_mapping["Benutzer"]
-            and exported_role["Rolle"] == existing_mapping["Rolle"]
-            for exported_role in user_array
-        ):
-            print(f"Mapping not found: {existing_mapping}")
-            changes.append(existing_mapping)
-
-    # Filter out mappings that are no longer needed
-    role_mappings = [mapping for mapping in role_mappings if mapping not in changes]
-
+    _, changes, role_mappings = diff_mappings(
+        current_mappings=user_array, documented_mappings=role_mappings
+    )
     if len(changes) == 0:
         changes = False
-
     return role_mappings, changes
 
 
@@ -158,24 +193,13 @@ def privileged_role_filter(role):
 def check_new_azure_resource_mappings(
     existing_role_mappings=[], new_role_mappings=[], headers=[]
 ):
-    changes = []
-    for new_role_mapping in new_role_mappings:
-        mapped = False
-        for existing_role_mapping in existing_role_mappings:
-            if (
-                new_role_mapping["Benutzer"] == existing_role_mapping["Benutzer"]
-                and new_role_mapping["Rolle"] == existing_role_mapping["Rolle"]
-                and new_role_mapping["Scope"] == existing_role_mapping["Scope"]
-            ):
-                mapped = True
-                break
-        if not mapped:
-            for header in headers:
-                if header not in new_role_mapping:
-                    new_role_mapping[header] = ""
-            print(f"New mapping: {new_role_mapping}")
-            existing_role_mappings.append(new_role_mapping)
-            changes.append(new_role_mapping)
+    changes, _, _ = diff_mappings(
+        current_mappings=new_role_mappings,
+        documented_mappings=existing_role_mappings,
+        keys=("Benutzer", "Rolle", "Scope"),
+        headers=headers,
+    )
+    existing_role_mappings.extend(changes)
     if len(changes) < 1:
         changes = False
     return existing_role_mappings, changes
@@ -184,72 +208,312 @@ def check_new_azure_resource_mappings(
 def check_removed_azure_resource_mappings(
     existing_role_mappings=[], new_role_mappings=[]
 ):
-    # Use list comprehension to find unmapped role mappings from existing_role_mappings.
-    changes = [
-        mapping
-        for mapping in existing_role_mappings
-        if not any(
-            (
-                new_mapping["Benutzer"] == mapping["Benutzer"]
-                and new_mapping["Rolle"] == mapping["Rolle"]
-                and new_mapping["Scope"] == mapping["Scope"]
+    _, changes, existing_role_mappings = diff_mappings(
+        current_mappings=new_role_mappings,
+        documented_mappings=existing_role_mappings,
+        keys=("Benutzer", "Rolle", "Scope"),
+    )
+    if changes:
+        return existing_role_mappings, changes
+    else:
+        # No changes to report
+        return existing_role_mappings, False
+
+
+# Extra keyword arguments for every ARM and Resource Graph client, e.g. base_url
+# and authentication_policy when the jobs run against the replay server
+AZURE_CLIENT_OVERRIDES = {}
+
+
+def azure_client_options(**kwargs):
+    # azure-core only retries connection and read errors, throttled calls and
+    # server errors are retried by the scheduler, which backs off the family
+    return {
+        "retry_status": 0,
+        **instrumentation.azure_client_hooks(),
+        **AZURE_CLIENT_OVERRIDES,
+        **kwargs,
+    }
+
+
+def build_shared_transport(pool_size=10):
+    # One connection pool reused by every ARM client and worker thread
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("https://", adapter)
+    from azure.core.pipeline.transport import RequestsTransport
+
+    return RequestsTransport(session=session, session_owner=False)
+
+
+def list_subscription_role_eligibilities(client, subscription_id):
+    scope = f"/subscriptions/{subscription_id}"
+    results = []
+    assignments = client.role_eligibility_schedule_instances.list_for_scope(scope)
+    for assignment in assignments:
+        expanded = assignment.expanded_properties
+        # end_date_time = assignment.end_date_time or "permanent"
+        result = {
+            "PrincipalName": expanded.principal.display_name,
+            # "PrincipalEmail": expanded.principal.email,
+            "PrincipalType": expanded.principal.type,
+            "PrincipalId": expanded.principal.id,
+            "RoleName": expanded.role_definition.display_name,
+            "RoleType": expanded.role_definition.type,
+            "RoleId": expanded.role_definition.id,
+            "ScopeId": expanded.scope.id,
+            "ScopeName": expanded.scope.display_name,
+            "ScopeType": expanded.scope.type,
+            # "Status": assignment.status,
+            # "createdOn": assignment.created_on,
+            # "startDateTime": assignment.start_date_time,
+            # "endDateTime": end_date_time,
+            # "updatedOn": assignment.updated_on,
+            "memberType": assignment.member_type,
+            # "id": assignment.id,
+        }
+        results.append(result)
+    return results
+
+
+def get_azure_resource_role_assignments(
+    subscription_ids, credential, max_workers=8, failed_subscriptions=None
+):
+    return list(
+        iter_azure_resource_role_assignments(
+            subscription_ids,
+            credential,
+            max_workers=max_workers,
+            failed_subscriptions=failed_subscriptions,
+        )
+    )
+
+
+def iter_azure_resource_role_assignments(
+    subscription_ids, credential, max_workers=8, failed_subscriptions=None
+):
+    # Subscriptions that cannot be loaded are appended to failed_subscriptions,
+    # their rows are missing and must not be read as removed
+    if failed_subscriptions is None:
+        failed_subscriptions = []
+    if isinstance(subscription_ids, str):
+        subscription_ids = [subscription_ids]
+    if not subscription_ids:
+        return
+
+    from azure.mgmt.authorization import AuthorizationManagementClient
+
+    # list_for_scope only depends on the scope, so one client serves every subscription
+    client = AuthorizationManagementClient(
+        credential,
+        subscription_ids[0],
+        **azure_client_options(transport=build_shared_transport(pool_size=max_workers)),
+    )
+
+    def collect(subscription_id):
+        start_function = time.perf_counter()
+        try:
+            results = scheduler.run_sync(
+                "arm", list_subscription_role_eligibilities, client, subscription_id
             )
-            for new_mapping in new_role_mappings
+        except Exception as e:
+            # A single failing subscription must not abort the whole run
+            logger.error(f"Cannot load role eligibilities for {subscription_id}: {e}")
+            Kestra.counter("Failed Subscriptions", 1)
+            failed_subscriptions.append(subscription_id)
+            return []
+        end_function = time.perf_counter()
+        logger.debug(
+            f"Loaded {len(results)} role eligibilities for {subscription_id} "
+            f"in {end_function - start_function:.2f}s"
         )
-    ]
+        return results
 
-    # If there are changes, remove the unmapped role mappings from existing_role_mappings.
-    if changes:
-        for change in changes:
-            print(f"Removed mapping: {change}")
-            existing_role_mappings.remove(change)
+    # Hand out every subscription as soon as it is loaded
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(collect, subscription_id)
+            for subscription_id in subscription_ids
+        ]
+        for future in as_completed(futures):
+            yield from future.result()
 
-        # Return updated lists
-        return existing_role_mappings, changes
 
+# Resource Graph caps a page at 1000 rows and a request at 1000 subscriptions
+RESOURCE_GRAPH_PAGE_SIZE = 1000
+RESOURCE_GRAPH_SUBSCRIPTION_LIMIT = 1000
+
+
+class ResourceGraphTruncatedError(Exception):
+    def __init__(self, query):
+        self.query = query
+        super().__init__(
+            "Resource Graph truncated the result without a skip token, "
+            "the query has to project id to be paged"
+        )
+
+
+def iter_resource_graph_pages(
+    resource_graph_client, query, subscriptions=None, top=RESOURCE_GRAPH_PAGE_SIZE
+):
+    from azure.mgmt.resourcegraph.models import QueryRequest, QueryRequestOptions
+
+    skip_token = None
+    while True:
+        request_options = QueryRequestOptions(
+            result_format="objectArray", top=top, skip_token=skip_token
+        )
+        query_request = QueryRequest(
+            subscriptions=subscriptions, query=query, options=request_options
+        )
+        response = scheduler.run_sync(
+            "resourcegraph", resource_graph_client.resources, query_request
+        )
+        logger.debug(f"Resource Graph page with {response.count} rows")
+        skip_token = response.skip_token
+        # Without a skip token a truncated result cannot be continued, the
+        # rows after the first page would silently be missing
+        if not skip_token and response.result_truncated == "true":
+            raise ResourceGraphTruncatedError(query)
+        yield response.data
+        if not skip_token:
+            break
+
+
+def iter_resource_graph(
+    query=None,
+    subscriptions=None,
+    credential=None,
+    top=RESOURCE_GRAPH_PAGE_SIZE,
+    chunk_size=RESOURCE_GRAPH_SUBSCRIPTION_LIMIT,
+    max_workers=4,
+):
+    if not query:
+        return
+    from azure.mgmt.resourcegraph import ResourceGraphClient
+
+    resource_graph_client = ResourceGraphClient(credential, **azure_client_options())
+    if not subscriptions:
+        chunks = [None]
     else:
-        # No changes to report
-        return existing_role_mappings, False
+        subscriptions = list(subscriptions)
+        chunks = [
+            subscriptions[i : i + chunk_size]
+            for i in range(0, len(subscriptions), chunk_size)
+        ]
+
+    if len(chunks) == 1:
+        for page in iter_resource_graph_pages(
+            resource_graph_client, query, subscriptions=chunks[0], top=top
+        ):
+            yield from page
+        return
+
+    # Page through the chunks concurrently and hand out rows as pages arrive
+    pages = queue.Queue()
+    stop = threading.Event()
+    done = object()
+
+    def collect(chunk):
+        try:
+            for page in iter_resource_graph_pages(
+                resource_graph_client, query, subscriptions=chunk, top=top
+            ):
+                if stop.is_set():
+                    break
+                pages.put(page)
+        except Exception as e:
+            pages.put(e)
+        finally:
+            pages.put(done)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for chunk in chunks:
+            executor.submit(collect, chunk)
+        try:
+            remaining = len(chunks)
+            while remaining:
+                page = pages.get()
+                if page is done:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield from page
+        finally:
+            stop.set()
+
+
+def query_resource_graph(query=None, subscriptions=None, credential=None):
+    if query:
+        return list(
+            iter_resource_graph(
+                query=query, subscriptions=subscriptions, credential=credential
+            )
+        )
+
+
+ROLE_ELIGIBILITY_QUERY = """
+authorizationresources
+| where type =~ 'microsoft.authorization/roleeligibilityscheduleinstances'
+| extend roleDefinitionId = tolower(tostring(properties.roleDefinitionId))
+| extend principalId = tostring(properties.principalId)
+| extend principalType = tostring(properties.principalType)
+| extend memberType = tostring(properties.memberType)
+| extend scope = tostring(properties.scope)
+| extend expanded = properties.expandedProperties
+| join kind = leftouter (
+authorizationresources
+| where type =~ 'microsoft.authorization/roledefinitions'
+| extend roleDefinitionId = tolower(id), roleName = tostring(properties.roleName), roleType = tostring(properties.type)
+| project roleDefinitionId, roleName, roleType
+) on roleDefinitionId
+| project id, principalId, principalType, principalName = tostring(expanded.principal.displayName), roleDefinitionId, roleName, roleType, scope, scopeName = tostring(expanded.scope.displayName), scopeType = tostring(expanded.scope.type), memberType
+"""
+
+
+def get_azure_resource_role_eligibilities_from_resource_graph(
+    subscription_ids, credential, subscription_dict={}
+):
+    return list(
+        iter_azure_resource_role_eligibilities_from_resource_graph(
+            subscription_ids, credential, subscription_dict=subscription_dict
+        )
+    )
 
 
-def get_azure_resource_role_assignments(subscription_ids, credential):
+def iter_azure_resource_role_eligibilities_from_resource_graph(
+    subscription_ids, credential, subscription_dict={}
+):
     if isinstance(subscription_ids, str):
         subscription_ids = [subscription_ids]
-    results = []
-    for subscription_id in subscription_ids:
-        scope = f"/subscriptions/{subscription_id}"
-        client = AuthorizationManagementClient(credential, subscription_id)
-        assignments = client.role_eligibility_schedule_instances.list_for_scope(scope)
-        for assignment in assignments:
-            expanded = assignment.expanded_properties
-            # end_date_time = assignment.end_date_time or "permanent"
-            result = {
-                "PrincipalName": expanded.principal.display_name,
-                # "PrincipalEmail": expanded.principal.email,
-                "PrincipalType": expanded.principal.type,
-                "PrincipalId": expanded.principal.id,
-                "RoleName": expanded.role_definition.display_name,
-                "RoleType": expanded.role_definition.type,
-                # "RoleId": expanded.role_definition.id,
-                # "ScopeId": expanded.scope.id,
-                "ScopeName": expanded.scope.display_name,
-                "ScopeType": expanded.scope.type,
-                # "Status": assignment.status,
-                # "createdOn": assignment.created_on,
-                # "startDateTime": assignment.start_date_time,
-                # "endDateTime": end_date_time,
-                # "updatedOn": assignment.updated_on,
-                "memberType": assignment.member_type,
-                # "id": assignment.id,
-            }
-            results.append(result)
-    return results
+    scope_resolver = ScopeResolver(subscription_dict=subscription_dict)
+    for row in iter_resource_graph(
+        ROLE_ELIGIBILITY_QUERY, subscriptions=subscription_ids, credential=credential
+    ):
+        scope_name, scope_type = scope_resolver.describe(row["scope"])
+        yield {
+            "PrincipalName": row["principalName"] or row["principalId"],
+            "PrincipalType": row["principalType"],
+            "PrincipalId": row["principalId"],
+            "RoleName": row["roleName"],
+            "RoleType": row["roleType"],
+            "RoleId": row["roleDefinitionId"],
+            "ScopeId": row["scope"],
+            "ScopeName": row["scopeName"] or scope_name,
+            "ScopeType": row["scopeType"] or scope_type,
+            "memberType": row["memberType"],
+        }
 
 
 def get_azure_subscriptions(credential=None, filters=None, starts_with=None, dict=False):
+    from azure.mgmt.subscription import SubscriptionClient
 
-    client = SubscriptionClient(credential)
-    response = client.subscriptions.list()
+    client = SubscriptionClient(credential, **azure_client_options())
+    # A fresh pager per attempt, so a retry starts from the first page again
+    response = scheduler.run_sync("arm", lambda: list(client.subscriptions.list()))
     if dict:
         subscriptions = {}
     else:
@@ -282,34 +546,48 @@ def get_azure_subscriptions(credential=None, filters=None, starts_with=None, dic
     return subscriptions
 
 
-async def build_azure_resource_assignments(
-    role_assignments={}, assignment_dict={}, groups_evaluated=[], graph_client=None
-):
+def collect_group_eligibilities(role_assignments, chunk_size=EXTERNAL_SORT_CHUNK_SIZE):
+    # Only group eligibilities are documented. They are reduced to compact
+    # ID tuples and deduplicated on disk, so nothing grows with the row count
+    # except the set of group IDs.
+    group_ids = set()
+    group_eligibilities = ExternalSorter(chunk_size=chunk_size)
     for role_assignment in role_assignments:
-        if role_assignment["PrincipalType"] == "Group":
-            if role_assignment["ScopeName"] not in assignment_dict:
-                assignment_dict[role_assignment["ScopeName"]] = {}
-
-            # Extract the elements for the new format
-            username = None
-            scope = role_assignment["ScopeName"]
-            role = role_assignment["RoleName"]
-
-            if role_assignment["PrincipalId"] not in groups_evaluated:
-                group_members = await graph_client.get_group_members(
-                    role_assignment["PrincipalId"]
+        if role_assignment["PrincipalType"] != "Group":
+            continue
+        assignment = make_assignment(
+            role_assignment["PrincipalId"],
+            role_assignment["RoleId"],
+            role_assignment["ScopeId"],
+        )
+        group_ids.add(assignment.principal_id)
+        group_eligibilities.add(
+            (*assignment, role_assignment["RoleName"], role_assignment["ScopeName"])
+        )
+    return group_ids, group_eligibilities
+
+
+def iter_azure_resource_assignments(
+    group_eligibilities, members_by_group, chunk_size=EXTERNAL_SORT_CHUNK_SIZE
+):
+    # Expands the groups into their members and yields the table rows sorted
+    # by user, scope and role. The IDs stay in the sort key so that users
+    # sharing a display name are kept apart.
+    rows = ExternalSorter(chunk_size=chunk_size)
+    for group_id, role_id, scope_id, role_name, scope_name in group_eligibilities:
+        for group_member in members_by_group[group_id]:
+            rows.add(
+                (
+                    group_member.display_name or group_member.id,
+                    scope_name or scope_id,
+                    role_name or role_id,
+                    sys.intern(group_member.id),
+                    scope_id,
+                    role_id,
                 )
-                groups_evaluated.append(role_assignment["PrincipalId"])
-                if len(group_members) > 0:
-
-                    # Add the extracted elements to the dictionary
-                    if scope not in assignment_dict:
-                        assignment_dict[scope] = {}
-
-                    if role not in assignment_dict[scope]:
-                        assignment_dict[scope][role] = []
-                    for group_member in group_members:
-                        user_display_name = group_member.display_name
-                        if user_display_name not in assignment_dict[scope][role]:
-                            assignment_dict[scope][role].append(user_display_name)
-    return assignment_dict, groups_evaluated
+            )
+    try:
+        for user, scope, role, *_ in rows:
+            yield {"Benutzer": user, "Scope": scope, "Rolle": role}
+    finally:
+        rows.close()
@@ -0,0 +1,316 @@
+import cProfile
+import contextvars
+import functools
+import inspect
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from kestra import Kestra
+from functions.recording import Recorder
+
+logger = Kestra.logger()
+
+# Path segments that identify an object rather than an API, collapsed so that
+# calls to the same endpoint share one name
+ID_SEGMENT_PATTERN = re.compile(
+    r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+)$",
+    re.IGNORECASE,
+)
+ENDPOINT_DEPTH = 6
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def endpoint_name(method, url):
+    parts = urlsplit(str(url))
+    segments = [
+        "{id}" if ID_SEGMENT_PATTERN.match(segment) else segment
+        for segment in parts.path.strip("/").split("/")[:ENDPOINT_DEPTH]
+        if segment
+    ]
+    return f"{method} {parts.netloc}/{'/'.join(segments)}"
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+
+class Instrumentation:
+    # Collects stage timings, per-endpoint request statistics and waits for
+    # the whole run. Stages are reported right away, everything else is
+    # aggregated and reported by finish().
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.counters = {}
+        self.waits = {}
+        self.request_starts = {}
+        self.trace_id = secrets.token_hex(16)
+        self.spans = None
+        self.profiler = None
+        self.profile_dir = None
+        self.recorder = None
+        self.hosts = {}
+
+    def start(self, profile=None, record=None, pseudonymize=True):
+        # With a profile directory the run also keeps a span per stage and
+        # request and is profiled with cProfile, with a record directory every
+        # exchange is written there for the replay server in benchmarks/
+        if record:
+            self.recorder = Recorder(
+                record, hosts=self.hosts, pseudonymize=pseudonymize
+            )
+        if not profile:
+            return
+        os.makedirs(profile, exist_ok=True)
+        self.profile_dir = profile
+        self.spans = []
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def _add_span(self, name, start, end, parent=None, span_id=None, **attributes):
+        if self.spans is None:
+            return
+        with self.lock:
+            self.spans.append(
+                {
+                    "traceId": self.trace_id,
+                    "spanId": span_id or secrets.token_hex(8),
+                    "parentSpanId": parent,
+                    "name": name,
+                    "startTimeUnixNano": int(start * 1e9),
+                    "endTimeUnixNano": int(end * 1e9),
+                    "attributes": attributes,
+                }
+            )
+
+    @contextmanager
+    def stage(self, name, **attributes):
+        span_id = secrets.token_hex(8)
+        parent = current_span.get()
+        token = current_span.set(span_id)
+        wall_start = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            current_span.reset(token)
+            Kestra.timer(name, duration)
+            self._add_span(
+                name,
+                wall_start,
+                wall_start + duration,
+                parent=parent,
+                span_id=span_id,
+                **attributes,
+            )
+
+    def timed(self, name=None):
+        # Decorator form of stage() for plain and async functions
+        def decorator(function):
+            stage_name = name or function.__name__
+            if inspect.iscoroutinefunction(function):
+
+                @functools.wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    with self.stage(stage_name):
+                        return await function(*args, **kwargs)
+
+                return async_wrapper
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage_name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def count(self, name, value=1, tags=None):
+        key = (name, tuple(sorted((tags or {}).items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def record_wait(self, family, seconds):
+        if seconds <= 0:
+            return
+        with self.lock:
+            self.waits[family] = self.waits.get(family, 0) + seconds
+
+    def record_request(
+        self, method, url, status, seconds, request_bytes=0, response_bytes=0
+    ):
+        endpoint = endpoint_name(method, url)
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, EndpointStats())
+            stats.requests += 1
+            stats.errors += status is None or status >= 400
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.request_bytes += request_bytes
+            stats.response_bytes += response_bytes
+        end = time.time()
+        self._add_span(
+            endpoint,
+            end - seconds,
+            end,
+            parent=current_span.get(),
+            status=status,
+            request_bytes=request_bytes,
+            response_bytes=response_bytes,
+        )
+
+    def add_host(self, url, placeholder):
+        # Recordings name this host by its placeholder instead of its URL
+        self.hosts[url.rstrip("/")] = placeholder
+        if self.recorder:
+            self.recorder.add_host(url, placeholder)
+
+    def httpx_event_hooks(self):
+        # For httpx.AsyncClient(event_hooks=...), the response body is read in
+        # the hook so its size and the download time are included
+        async def on_request(request):
+            self.request_starts[id(request)] = time.perf_counter()
+
+        async def on_response(response):
+            await response.aread()
+            request = response.request
+            start = self.request_starts.pop(id(request), None)
+            self.record_request(
+                request.method,
+                request.url,
+                response.status_code,
+                time.perf_counter() - start if start else 0,
+                request_bytes=int(request.headers.get("content-length") or 0),
+                response_bytes=len(response.content),
+            )
+            if self.recorder:
+                self.recorder.record(
+                    request.method,
+                    request.url,
+                    request.content,
+                    response.status_code,
+                    response.headers,
+                    response.content,
+                    request_headers=request.headers,
+                )
+
+        return {"request": [on_request], "response": [on_response]}
+
+    def azure_client_hooks(self):
+        # Keyword arguments for azure-core based clients, handled by their
+        # CustomHookPolicy on every request
+        def on_request(request):
+            request.context["instrumentation_start"] = time.perf_counter()
+
+        def on_response(response):
+            start = response.context.get("instrumentation_start")
+            http_request = response.http_request
+            http_response = response.http_response
+            try:
+                body = http_response.body() or b""
+            except Exception:
+                body = None
+            self.record_request(
+                http_request.method,
+                http_request.url,
+                http_response.status_code,
+                time.perf_counter() - start if start else 0,
+                request_bytes=int(http_request.headers.get("Content-Length") or 0),
+                response_bytes=(
+                    len(body)
+                    if body is not None
+                    else int(http_response.headers.get("Content-Length") or 0)
+                ),
+            )
+            if self.recorder and body is not None:
+                self.recorder.record(
+                    http_request.method,
+                    http_request.url,
+                    getattr(http_request, "content", None)
+                    or getattr(http_request, "body", None),
+                    http_response.status_code,
+                    http_response.headers,
+                    body,
+                    request_headers=http_request.headers,
+                )
+
+        return {"raw_request_hook": on_request, "raw_response_hook": on_response}
+
+    def requests_hooks(self):
+        # For requests.Session.hooks, used by the Confluence client
+        def on_response(response, *args, **kwargs):
+            request = response.request
+            self.record_request(
+                request.method,
+                request.url,
+                response.status_code,
+                response.elapsed.total_seconds(),
+                request_bytes=len(request.body or b""),
+                response_bytes=len(response.content),
+            )
+            if self.recorder:
+                self.recorder.record(
+                    request.method,
+                    request.url,
+                    request.body,
+                    response.status_code,
+                    response.headers,
+                    response.content,
+                    request_headers=request.headers,
+                )
+
+        return {"response": [on_response]}
+
+    def finish(self):
+        with self.lock:
+            endpoints = dict(self.endpoints)
+            counters = dict(self.counters)
+            waits = dict(self.waits)
+        for endpoint, stats in sorted(
+            endpoints.items(), key=lambda item: item[1].seconds, reverse=True
+        ):
+            tags = {"endpoint": endpoint}
+            Kestra.counter("Requests", stats.requests, tags)
+            Kestra.counter("Failed Requests", stats.errors, tags)
+            Kestra.counter("Request Bytes", stats.request_bytes, tags)
+            Kestra.counter("Response Bytes", stats.response_bytes, tags)
+            Kestra.timer("Request Duration", stats.seconds, tags)
+            logger.debug(
+                f"{endpoint}: {stats.requests} requests, {stats.seconds:.2f}s total, "
+                f"{stats.max_seconds:.2f}s max, {stats.response_bytes} bytes"
+            )
+        for (name, tags), value in counters.items():
+            Kestra.counter(name, value, dict(tags))
+        for family, seconds in waits.items():
+            Kestra.timer("Throttle Wait", seconds, {"family": family})
+
+        if self.profiler:
+            self.profiler.disable()
+            profile_path = os.path.join(self.profile_dir, "profile.prof")
+            self.profiler.dump_stats(profile_path)
+            trace_path = os.path.join(self.profile_dir, "trace.json")
+            with open(trace_path, "w") as trace_file:
+                json.dump({"spans": self.spans}, trace_file, indent=1)
+            logger.info(f"Wrote {profile_path} and {trace_path}")
+        if self.recorder:
+            self.recorder.close()
+            logger.info(f"Recorded exchanges to {self.recorder.path}")
+
+
+# Shared by every stage and client of a run
+instrumentation = Instrumentation()
+stage = instrumentation.stage
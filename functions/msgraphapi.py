@@ -1,40 +1,504 @@
-from msgraph import GraphServiceClient
+import asyncio
+import functools
+import json
+import sqlite3
+import time
+from collections import OrderedDict, namedtuple
 from kestra import Kestra
+from functions.throttling import RETRYABLE_STATUS_CODES, parse_retry_after, scheduler
+from functions.instrumentation import instrumentation
 
 logger = Kestra.logger()
-from msgraph.generated.role_management.directory.role_eligibility_schedules.role_eligibility_schedules_request_builder import (
-    RoleEligibilitySchedulesRequestBuilder,
-)
-from msgraph.generated.groups.item.members.count.count_request_builder import (
-    CountRequestBuilder,
-)
-from msgraph.generated.role_management.directory.role_assignments.role_assignments_request_builder import (
-    RoleAssignmentsRequestBuilder,
-)
-from kiota_abstractions.base_request_configuration import RequestConfiguration
-from azure.identity.aio import ClientSecretCredential
-from msgraph.generated.role_management.directory.role_assignments.item.unified_role_assignment_item_request_builder import (
-    UnifiedRoleAssignmentItemRequestBuilder,
+
+# The Graph SDK, kiota, httpx and azure-identity are imported where they are
+# first used, the generated msgraph model tree alone takes longer to import
+# than the rest of a script's startup
+
+# Slim, serialisable view of a directory object as used by the audit tables
+DirectoryObject = namedtuple(
+    "DirectoryObject", ["id", "display_name", "user_principal_name", "odata_type"]
 )
 
+GROUP_ODATA_TYPE = "#microsoft.graph.group"
+# @odata.type is always part of the response and cannot be selected explicitly
+GROUP_MEMBER_SELECT = ["id", "displayName", "userPrincipalName"]
+GROUP_MEMBER_PAGE_SIZE = 999
+
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
+# Graph accepts at most 20 sub-requests per $batch call
+GRAPH_BATCH_SIZE = 20
+# directoryObjects/getByIds accepts up to 1000 IDs per call
+GET_BY_IDS_CHUNK_SIZE = 1000
+
+
+class GraphBatchError(Exception):
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+        super().__init__(f"Graph batch sub-request failed with status {status}: {body}")
+
+
+class GraphBatchRetry(Exception):
+    # Raised for the sub-requests of a $batch call that should be sent again,
+    # it looks like a failed single request to the scheduler
+    def __init__(self, responses):
+        self.responses = responses
+        statuses = [response["status"] for response in responses.values()]
+        self.response_status_code = 429 if 429 in statuses else max(statuses)
+        delays = [
+            parse_retry_after(response.get("headers") or {})
+            for response in responses.values()
+        ]
+        delays = [delay for delay in delays if delay is not None]
+        self.response_headers = {"Retry-After": str(max(delays))} if delays else {}
+        super().__init__(
+            f"{len(responses)} batched requests failed with {self.response_status_code}"
+        )
+
+
+def to_directory_object(graph_object):
+    return DirectoryObject(
+        id=graph_object.id,
+        display_name=graph_object.display_name,
+        user_principal_name=getattr(graph_object, "user_principal_name", None),
+        odata_type=graph_object.odata_type,
+    )
+
+
+def directory_object_from_json(value):
+    return DirectoryObject(
+        id=value.get("id"),
+        display_name=value.get("displayName"),
+        user_principal_name=value.get("userPrincipalName"),
+        odata_type=value.get("@odata.type"),
+    )
+
+
+def compute_group_closures(edges, group_ids):
+    # Flatten nested groups with Tarjan's SCC algorithm: components come out
+    # in reverse topological order, so every sub-group closure is ready before
+    # it is needed and groups in a cycle share one closure.
+    def subgroups(group_id):
+        return [
+            member.id
+            for member in edges[group_id]
+            if member.odata_type == GROUP_ODATA_TYPE and member.id in edges
+        ]
+
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    closures = {}
+    for root in group_ids:
+        if root not in edges or root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(subgroups(root)))]
+        while work:
+            group_id, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(subgroups(child))))
+                    break
+                elif child in on_stack:
+                    lowlink[group_id] = min(lowlink[group_id], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[group_id])
+                if lowlink[group_id] != index[group_id]:
+                    continue
+                component = set()
+                while True:
+                    member_id = stack.pop()
+                    on_stack.discard(member_id)
+                    component.add(member_id)
+                    if member_id == group_id:
+                        break
+                if len(component) > 1 or group_id in subgroups(group_id):
+                    logger.warning(
+                        f"Nested group cycle detected between {len(component)} groups, including {group_id}"
+                    )
+                closure = {}
+                for component_group in component:
+                    for member in edges[component_group]:
+                        if member.odata_type != GROUP_ODATA_TYPE:
+                            closure[member.id] = member
+                        elif member.id in closures and member.id not in component:
+                            closure.update(closures[member.id])
+                for component_group in component:
+                    closures[component_group] = closure
+    return {
+        group_id: list(closures[group_id].values())
+        for group_id in group_ids
+        if group_id in closures
+    }
+
+
+class GroupMemberCache:
+    def __init__(self, path=None, ttl=3600, max_size=10000):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        # Writes are collected and stored in one transaction by flush()
+        self.pending = {}
+        self.touched = {}
+        if path:
+            self.connection = sqlite3.connect(path, isolation_level=None)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS group_members ("
+                "group_id TEXT PRIMARY KEY, members TEXT, fetched_at REAL, used_at REAL)"
+            )
+
+    def _expired(self, fetched_at):
+        return self.ttl is not None and time.time() - fetched_at > self.ttl
+
+    def _remember(self, group_id, members, fetched_at):
+        self.entries[group_id] = (members, fetched_at)
+        self.entries.move_to_end(group_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, group_id):
+        if group_id in self.entries:
+            members, fetched_at = self.entries[group_id]
+            if not self._expired(fetched_at):
+                self.entries.move_to_end(group_id)
+                self.hits += 1
+                instrumentation.count("Group Member Cache", 1, {"result": "hit"})
+                return members
+            del self.entries[group_id]
+
+        if self.connection:
+            row = self.connection.execute(
+                "SELECT members, fetched_at FROM group_members WHERE group_id = ?",
+                (group_id,),
+            ).fetchone()
+            if row and not self._expired(row[1]):
+                members = [DirectoryObject(*member) for member in json.loads(row[0])]
+                self.touched[group_id] = time.time()
+                self._remember(group_id, members, row[1])
+                self.hits += 1
+                instrumentation.count("Group Member Cache", 1, {"result": "hit"})
+                return members
+
+        self.misses += 1
+        instrumentation.count("Group Member Cache", 1, {"result": "miss"})
+        return None
+
+    def set(self, group_id, members):
+        fetched_at = time.time()
+        self._remember(group_id, members, fetched_at)
+        if self.connection:
+            self.pending[group_id] = (json.dumps(members), fetched_at)
+            self.touched.pop(group_id, None)
+
+    def flush(self):
+        # Called once per fan-out, the most recently used groups are kept on disk
+        if not self.connection or not (self.pending or self.touched):
+            return
+        self.connection.execute("BEGIN")
+        try:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO group_members VALUES (?, ?, ?, ?)",
+                (
+                    (group_id, members, fetched_at, fetched_at)
+                    for group_id, (members, fetched_at) in self.pending.items()
+                ),
+            )
+            self.connection.executemany(
+                "UPDATE group_members SET used_at = ? WHERE group_id = ?",
+                ((used_at, group_id) for group_id, used_at in self.touched.items()),
+            )
+            self.connection.execute(
+                "DELETE FROM group_members WHERE group_id IN (SELECT group_id "
+                "FROM group_members ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_size,),
+            )
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.pending.clear()
+        self.touched.clear()
+
+    def invalidate(self, group_id):
+        self.entries.pop(group_id, None)
+        self.pending.pop(group_id, None)
+        self.touched.pop(group_id, None)
+        if self.connection:
+            self.connection.execute(
+                "DELETE FROM group_members WHERE group_id = ?", (group_id,)
+            )
+
+    def clear(self):
+        self.entries.clear()
+        self.pending.clear()
+        self.touched.clear()
+        if self.connection:
+            self.connection.execute("DELETE FROM group_members")
+
+    def close(self):
+        if self.connection:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+
+class DirectorySnapshot:
+    def __init__(self, path=None):
+        # Without a path the snapshot only lives for the current run
+        self.connection = sqlite3.connect(path or ":memory:", isolation_level=None)
+        self.connection.executescript(
+            "CREATE TABLE IF NOT EXISTS directory_users ("
+            "id TEXT PRIMARY KEY, display_name TEXT, user_principal_name TEXT);"
+            "CREATE TABLE IF NOT EXISTS directory_groups ("
+            "id TEXT PRIMARY KEY, display_name TEXT);"
+            "CREATE TABLE IF NOT EXISTS delta_links ("
+            "resource TEXT PRIMARY KEY, link TEXT);"
+        )
+
+    def get_delta_link(self, resource):
+        row = self.connection.execute(
+            "SELECT link FROM delta_links WHERE resource = ?", (resource,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def apply(self, resource, changes, delta_link, full_sync=False):
+        # All changes of a sync land together with their delta link or not at all
+        table = f"directory_{resource}"
+        self.connection.execute("BEGIN")
+        try:
+            if full_sync:
+                self.connection.execute(f"DELETE FROM {table}")
+            for object_id, values in changes.items():
+                if values is None:
+                    self.connection.execute(
+                        f"DELETE FROM {table} WHERE id = ?", (object_id,)
+                    )
+                    continue
+                columns = ", ".join(["id", *values])
+                placeholders = ", ".join("?" * (len(values) + 1))
+                # Updated objects may only carry the properties that changed
+                updates = ", ".join(
+                    f"{column} = COALESCE(excluded.{column}, {column})"
+                    for column in values
+                )
+                self.connection.execute(
+                    f"INSERT INTO {table} ({columns}) VALUES ({placeholders}) "
+                    f"ON CONFLICT(id) DO UPDATE SET {updates}",
+                    (object_id, *values.values()),
+                )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO delta_links VALUES (?, ?)",
+                (resource, delta_link),
+            )
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def get_display_names(self, resource):
+        return dict(
+            self.connection.execute(
+                f"SELECT id, display_name FROM directory_{resource}"
+            )
+        )
+
+    def close(self):
+        self.connection.close()
+
 
 class GraphAPI:
     def __init__(
-        self, azure_tenant_id=None, azure_client_id=None, azure_client_secret=None
+        self,
+        azure_tenant_id=None,
+        azure_client_id=None,
+        azure_client_secret=None,
+        max_concurrency=10,
+        cache_path=None,
+        cache_ttl=3600,
+        cache_size=10000,
+        transitive=False,
+        request_scheduler=None,
+        base_url=GRAPH_BASE_URL,
+        credential=None,
     ):
         self.azure_tenant_id = azure_tenant_id
         self.azure_client_id = azure_client_id
         self.azure_client_secret = azure_client_secret
-        self._auth()
+        # Upper bound for Graph requests in flight during fan-outs
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # Flatten nested groups into their user members
+        self.transitive = transitive
+        # Rate limiting and retries shared with the ARM and Resource Graph calls
+        self.scheduler = request_scheduler or scheduler
+        self.group_member_cache = GroupMemberCache(
+            path=cache_path, ttl=cache_ttl, max_size=cache_size
+        )
+        self.directory_snapshot = DirectorySnapshot(path=cache_path)
+        self.group_sync_lock = asyncio.Lock()
+        self.groups_synced = False
+        # Resolved principals by ID, None for objects that no longer exist
+        self.directory_objects = {}
+        # Another endpoint and credential are only used against the replay server
+        self.base_url = base_url
+        self.scopes = GRAPH_SCOPES
+        # The credential and both clients are built on first use, so runs
+        # that never reach Graph do not pay for the SDK imports
+        self._credential = credential
 
-    def _auth(self):
-        self.credential = ClientSecretCredential(
+    @functools.cached_property
+    def credential(self):
+        if self._credential:
+            return self._credential
+        from azure.identity.aio import ClientSecretCredential
+
+        return ClientSecretCredential(
             self.azure_tenant_id, self.azure_client_id, self.azure_client_secret
         )
-        self.scopes = ["https://graph.microsoft.com/.default"]
-        self.graph_client = GraphServiceClient(self.credential, scopes=self.scopes)
+
+    @functools.cached_property
+    def graph_client(self):
+        from kiota_authentication_azure.azure_identity_authentication_provider import (
+            AzureIdentityAuthenticationProvider,
+        )
+        from msgraph import GraphServiceClient
+        from msgraph.graph_request_adapter import GraphRequestAdapter
+        from msgraph_core import GraphClientFactory
+        from kiota_http.middleware.options import RetryHandlerOption
+
+        # Own httpx client so every SDK request passes the instrumentation hooks.
+        # The SDK retry handler is off, 429s have to reach the scheduler so it
+        # can back off and count them.
+        sdk_http_client = GraphClientFactory.create_with_default_middleware(
+            options={RetryHandlerOption.get_key(): RetryHandlerOption(max_retries=0)}
+        )
+        sdk_http_client.event_hooks = instrumentation.httpx_event_hooks()
+        request_adapter = GraphRequestAdapter(
+            AzureIdentityAuthenticationProvider(self.credential, scopes=self.scopes),
+            client=sdk_http_client,
+        )
+        request_adapter.base_url = self.base_url
+        return GraphServiceClient(request_adapter=request_adapter)
+
+    @functools.cached_property
+    def http_client(self):
+        import httpx
+
+        # Plain HTTP client for $batch calls, which the generated SDK does not cover
+        return httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=60,
+            event_hooks=instrumentation.httpx_event_hooks(),
+        )
+
+    async def _post_batch(self, batch_requests):
+        token = await self.credential.get_token(*self.scopes)
+        response = await self.http_client.post(
+            "/$batch",
+            json={"requests": batch_requests},
+            headers={"Authorization": f"Bearer {token.token}"},
+        )
+        response.raise_for_status()
+        return response.json()["responses"]
+
+    async def _send_batch(self, batch_requests):
+        # Throttled or failed sub-requests are sent again through the scheduler,
+        # so they back off the limiter and are counted like single requests
+        pending = {request["id"]: request for request in batch_requests}
+        responses = {}
+
+        async def send():
+            retry = {}
+            for response in await self._post_batch(list(pending.values())):
+                if response["status"] in RETRYABLE_STATUS_CODES:
+                    retry[response["id"]] = response
+                    continue
+                responses[response["id"]] = response
+                pending.pop(response["id"])
+            if retry:
+                raise GraphBatchRetry(retry)
+
+        async with self.semaphore:
+            try:
+                await self.scheduler.run("graph", send)
+            except GraphBatchRetry as error:
+                # Out of retries, the callers see the last responses as they are
+                logger.warning(str(error))
+                responses.update(error.responses)
+        return [responses[request["id"]] for request in batch_requests]
+
+    async def batch(self, requests):
+        # requests are {"method", "url", ...} dicts with URLs relative to v1.0;
+        # responses come back in the same order as the requests
+        chunks = [
+            [
+                {"id": str(index), **request}
+                for index, request in enumerate(
+                    requests[i : i + GRAPH_BATCH_SIZE], start=i
+                )
+            ]
+            for i in range(0, len(requests), GRAPH_BATCH_SIZE)
+        ]
+        logger.debug(f"Sending {len(requests)} requests in {len(chunks)} batches")
+        results = await asyncio.gather(*(self._send_batch(chunk) for chunk in chunks))
+        return [response for chunk_responses in results for response in chunk_responses]
+
+    async def get_members_of_groups_batched(self, group_ids):
+        members_by_group = {group_id: [] for group_id in group_ids}
+        select = ",".join(GROUP_MEMBER_SELECT)
+        pending = {
+            group_id: f"/groups/{group_id}/members?$select={select}&$top={GROUP_MEMBER_PAGE_SIZE}"
+            for group_id in group_ids
+        }
+        # Every round fetches the next page of each group that still has one
+        while pending:
+            group_page_ids = list(pending)
+            responses = await self.batch(
+                [
+                    {
+                        "method": "GET",
+                        "url": pending[group_id],
+                        "headers": {"ConsistencyLevel": "eventual"},
+                    }
+                    for group_id in group_page_ids
+                ]
+            )
+            pending = {}
+            for group_id, response in zip(group_page_ids, responses):
+                if response["status"] != 200:
+                    members_by_group[group_id] = GraphBatchError(
+                        response["status"], response.get("body")
+                    )
+                    continue
+                body = response["body"]
+                members_by_group[group_id].extend(
+                    directory_object_from_json(value) for value in body["value"]
+                )
+                if body.get("@odata.nextLink"):
+                    pending[group_id] = body["@odata.nextLink"].removeprefix(
+                        self.base_url
+                    )
+        return members_by_group
 
     async def get_role_eligibility_schedules(self):
+        from kiota_abstractions.base_request_configuration import RequestConfiguration
+        from msgraph.generated.role_management.directory.role_eligibility_schedules.role_eligibility_schedules_request_builder import (
+            RoleEligibilitySchedulesRequestBuilder,
+        )
 
         query_params = RoleEligibilitySchedulesRequestBuilder.RoleEligibilitySchedulesRequestBuilderGetQueryParameters(
             select=["principalId", "roleDefinitionId"],
@@ -47,46 +511,221 @@ class GraphAPI:
         )
         schedules = []
         logger.debug("Getting first page of role eligibility schedules")
-        result = await self.graph_client.role_management.directory.role_eligibility_schedules.get(
-            request_configuration=request_configuration
+        result = await self.scheduler.run(
+            "graph",
+            self.graph_client.role_management.directory.role_eligibility_schedules.get,
+            request_configuration=request_configuration,
         )
         schedules.extend(result.value)
         # Pagination if next_link is present
         while result.odata_next_link:
             logger.debug("Getting next page of role eligibility schedules")
-            result = await self.graph_client.role_management.directory.role_eligibility_schedules.with_url(
-                result.odata_next_link
-            ).get(
-                request_configuration=request_configuration
+            result = await self.scheduler.run(
+                "graph",
+                self.graph_client.role_management.directory.role_eligibility_schedules.with_url(
+                    result.odata_next_link
+                ).get,
+                request_configuration=request_configuration,
             )
             schedules.extend(result.value)
         return schedules
 
-    async def get_group_members(self, group_id):
+    async def iter_group_members(self, group_id, page_size=GROUP_MEMBER_PAGE_SIZE):
+        from kiota_abstractions.base_request_configuration import RequestConfiguration
+        from msgraph.generated.groups.item.members.members_request_builder import (
+            MembersRequestBuilder,
+        )
 
-        request_configuration = RequestConfiguration()
+        query_params = MembersRequestBuilder.MembersRequestBuilderGetQueryParameters(
+            select=GROUP_MEMBER_SELECT,
+            top=page_size,
+        )
+        request_configuration = RequestConfiguration(
+            query_parameters=query_params,
+        )
         request_configuration.headers.add("ConsistencyLevel", "eventual")
 
-        result = await self.graph_client.groups.by_group_id(group_id).members.get()
-        return result.value
+        members_builder = self.graph_client.groups.by_group_id(group_id).members
+        logger.debug(f"Getting first page of members of group {group_id}")
+        result = await self.scheduler.run(
+            "graph", members_builder.get, request_configuration=request_configuration
+        )
+        next_page = None
+        try:
+            while True:
+                # Request the next page before handing out the current one
+                if result.odata_next_link:
+                    logger.debug(f"Getting next page of members of group {group_id}")
+                    next_page = asyncio.ensure_future(
+                        self.scheduler.run(
+                            "graph",
+                            members_builder.with_url(result.odata_next_link).get,
+                            request_configuration=request_configuration,
+                        )
+                    )
+                for member in result.value:
+                    yield to_directory_object(member)
+                if not next_page:
+                    break
+                result = await next_page
+                next_page = None
+        finally:
+            if next_page:
+                next_page.cancel()
+
+    async def get_group_members(self, group_id):
+        members = self.group_member_cache.get(group_id)
+        if members is not None:
+            logger.debug(f"Group {group_id} served from cache")
+            return members
+
+        members = [member async for member in self.iter_group_members(group_id)]
+        self.group_member_cache.set(group_id, members)
+        self.group_member_cache.flush()
+        return members
+
+    async def refresh_group_member_cache(self):
+        # A persisted cache may hold memberships that changed since the last run
+        async with self.group_sync_lock:
+            if not self.groups_synced:
+                await self.sync_groups()
+                self.groups_synced = True
+
+    async def get_members_of_groups(self, group_ids, return_exceptions=False):
+        if self.group_member_cache.connection:
+            await self.refresh_group_member_cache()
+        if self.transitive:
+            return await self.get_transitive_members_of_groups(
+                group_ids, return_exceptions=return_exceptions
+            )
+        return await self.get_direct_members_of_groups(
+            group_ids, return_exceptions=return_exceptions
+        )
+
+    async def resolve_directory_objects(self, object_ids):
+        object_ids = list(dict.fromkeys(object_ids))
+        missing = [
+            object_id
+            for object_id in object_ids
+            if object_id not in self.directory_objects
+        ]
+        chunks = [
+            missing[i : i + GET_BY_IDS_CHUNK_SIZE]
+            for i in range(0, len(missing), GET_BY_IDS_CHUNK_SIZE)
+        ]
+        logger.debug(f"Resolving {len(missing)} principals in {len(chunks)} chunks")
+        responses = await self.batch(
+            [
+                {
+                    "method": "POST",
+                    "url": "/directoryObjects/getByIds",
+                    "headers": {"Content-Type": "application/json"},
+                    "body": {
+                        "ids": chunk,
+                        "types": ["user", "group", "servicePrincipal"],
+                    },
+                }
+                for chunk in chunks
+            ]
+        )
+        for chunk, response in zip(chunks, responses):
+            if response["status"] != 200:
+                raise GraphBatchError(response["status"], response.get("body"))
+            for object_id in chunk:
+                self.directory_objects[object_id] = None
+            for value in response["body"]["value"]:
+                self.directory_objects[value["id"]] = directory_object_from_json(value)
+        return {
+            object_id: self.directory_objects[object_id] for object_id in object_ids
+        }
+
+    async def get_direct_members_of_groups(self, group_ids, return_exceptions=False):
+        members_by_group = {}
+        missing = []
+        for group_id in dict.fromkeys(group_ids):
+            members = self.group_member_cache.get(group_id)
+            if members is None:
+                missing.append(group_id)
+            else:
+                members_by_group[group_id] = members
+
+        # Cache misses are resolved together, 20 groups per $batch call
+        logger.debug(f"Expanding {len(missing)} groups")
+        fetched = await self.get_members_of_groups_batched(missing)
+        for group_id, members in fetched.items():
+            if isinstance(members, Exception):
+                if not return_exceptions:
+                    raise members
+            else:
+                self.group_member_cache.set(group_id, members)
+            members_by_group[group_id] = members
+        self.group_member_cache.flush()
+        return members_by_group
+
+    async def get_transitive_members_of_groups(
+        self, group_ids, return_exceptions=False
+    ):
+        group_ids = list(dict.fromkeys(group_ids))
+        edges = {}
+        failures = {}
+        pending = group_ids
+        # Walk the nesting level by level so every group is fetched only once
+        while pending:
+            fetched = await self.get_direct_members_of_groups(
+                pending, return_exceptions=True
+            )
+            discovered = []
+            for group_id, members in fetched.items():
+                if isinstance(members, Exception):
+                    failures[group_id] = members
+                    continue
+                edges[group_id] = members
+                for member in members:
+                    if member.odata_type == GROUP_ODATA_TYPE:
+                        discovered.append(member.id)
+            pending = [
+                group_id
+                for group_id in dict.fromkeys(discovered)
+                if group_id not in edges and group_id not in failures
+            ]
+
+        for group_id, error in failures.items():
+            if group_id not in group_ids:
+                logger.error(f"Cannot expand nested group {group_id}: {error}")
+            elif not return_exceptions:
+                raise error
+
+        members_by_group = compute_group_closures(edges, group_ids)
+        for group_id in group_ids:
+            if group_id in failures:
+                members_by_group[group_id] = failures[group_id]
+        return members_by_group
 
     async def get_entraid_roles(self):
 
-        result = (
-            await self.graph_client.role_management.directory.role_definitions.get()
+        result = await self.scheduler.run(
+            "graph", self.graph_client.role_management.directory.role_definitions.get
         )
         roles = []
         roles.extend(result.value)
         # Pagination if next_link is present
         while result.odata_next_link:
             logger.debug("Getting next page of role eligibility schedules")
-            result = await self.graph_client.role_management.directory.role_definitions.with_url(
-                result.odata_next_link
-            ).get()
+            result = await self.scheduler.run(
+                "graph",
+                self.graph_client.role_management.directory.role_definitions.with_url(
+                    result.odata_next_link
+                ).get,
+            )
             roles.extend(result.value)
         return roles
 
     async def get_entraid_role_assignments(self):
+        from kiota_abstractions.base_request_configuration import RequestConfiguration
+        from msgraph.generated.role_management.directory.role_assignments.item.unified_role_assignment_item_request_builder import (
+            UnifiedRoleAssignmentItemRequestBuilder,
+        )
+
         query_params = UnifiedRoleAssignmentItemRequestBuilder.UnifiedRoleAssignmentItemRequestBuilderGetQueryParameters(
             expand=["principal"],
         )
@@ -95,8 +734,10 @@ class GraphAPI:
             query_parameters=query_params,
         )
 
-        result = await self.graph_client.role_management.directory.role_assignments.get(
-            request_configuration=request_configuration
+        result = await self.scheduler.run(
+            "graph",
+            self.graph_client.role_management.directory.role_assignments.get,
+            request_configuration=request_configuration,
         )
         from pprint import pprint
 
@@ -104,10 +745,12 @@ class GraphAPI:
         role_assignments.extend(result.value)
         while result.odata_next_link:
             logger.debug("Getting next page of role eligibility schedules")
-            result = await self.graph_client.role_management.directory.role_assignments.with_url(
-                result.odata_next_link
-            ).get(
-                request_configuration=request_configuration
+            result = await self.scheduler.run(
+                "graph",
+                self.graph_client.role_management.directory.role_assignments.with_url(
+                    result.odata_next_link
+                ).get,
+                request_configuration=request_configuration,
             )
             role_assignments.extend(result.value)
         return role_assignments
@@ -115,26 +758,142 @@ class GraphAPI:
     async def get_all_users(self):
         users = []
         logger.debug("Getting first page of all users")
-        result = await self.graph_client.users.get()
+        result = await self.scheduler.run("graph", self.graph_client.users.get)
         users.extend(result.value)
         # Pagination if next_link is present
         while result.odata_next_link:
             logger.debug("Getting next page of all users")
-            result = await self.graph_client.users.with_url(
-                result.odata_next_link
-            ).get()
+            result = await self.scheduler.run(
+                "graph", self.graph_client.users.with_url(result.odata_next_link).get
+            )
             users.extend(result.value)
         return users
 
     async def get_all_groups(self):
         groups = []
         logger.debug("Getting first page of all groups")
-        result = await self.graph_client.groups.get()
+        result = await self.scheduler.run("graph", self.graph_client.groups.get)
         groups.extend(result.value)
         while result.odata_next_link:
             logger.debug("Getting next page of all groups")
-            result = await self.graph_client.groups.with_url(
-                result.odata_next_link
-            ).get()
+            result = await self.scheduler.run(
+                "graph", self.graph_client.groups.with_url(result.odata_next_link).get
+            )
             groups.extend(result.value)
         return groups
+
+    async def _sync_delta(
+        self, resource, delta_builder, request_configuration, parse, on_full_sync=None
+    ):
+        from kiota_abstractions.api_error import APIError
+
+        delta_link = self.directory_snapshot.get_delta_link(resource)
+        if not delta_link and on_full_sync:
+            on_full_sync()
+        changes = {}
+        try:
+            if delta_link:
+                logger.debug(f"Getting {resource} changes since the last run")
+                result = await self.scheduler.run(
+                    "graph", delta_builder.with_url(delta_link).get
+                )
+            else:
+                logger.debug(f"Getting first page of {resource} delta")
+                result = await self.scheduler.run(
+                    "graph",
+                    delta_builder.get,
+                    request_configuration=request_configuration,
+                )
+            for item in result.value:
+                changes[item.id] = parse(item)
+            # Pagination if next_link is present
+            while result.odata_next_link:
+                logger.debug(f"Getting next page of {resource} delta")
+                result = await self.scheduler.run(
+                    "graph", delta_builder.with_url(result.odata_next_link).get
+                )
+                for item in result.value:
+                    changes[item.id] = parse(item)
+        except APIError as e:
+            # 410 Gone means the delta token expired and a full resync is needed
+            if delta_link and e.response_status_code == 410:
+                logger.warning(f"Delta token for {resource} expired, running full sync")
+                self.directory_snapshot.apply(resource, {}, None, full_sync=True)
+                return await self._sync_delta(
+                    resource, delta_builder, request_configuration, parse, on_full_sync
+                )
+            raise
+        self.directory_snapshot.apply(
+            resource, changes, result.odata_delta_link, full_sync=not delta_link
+        )
+        logger.debug(f"Applied {len(changes)} {resource} changes")
+        return changes
+
+    async def sync_users(self):
+        from kiota_abstractions.base_request_configuration import RequestConfiguration
+        from msgraph.generated.users.delta.delta_request_builder import (
+            DeltaRequestBuilder as UsersDeltaRequestBuilder,
+        )
+
+        query_params = UsersDeltaRequestBuilder.DeltaRequestBuilderGetQueryParameters(
+            select=["id", "displayName", "userPrincipalName"],
+        )
+        request_configuration = RequestConfiguration(
+            query_parameters=query_params,
+        )
+
+        def parse(user):
+            if user.additional_data and "@removed" in user.additional_data:
+                return None
+            return {
+                "display_name": user.display_name,
+                "user_principal_name": user.user_principal_name,
+            }
+
+        return await self._sync_delta(
+            "users", self.graph_client.users.delta, request_configuration, parse
+        )
+
+    async def sync_groups(self):
+        from kiota_abstractions.base_request_configuration import RequestConfiguration
+        from msgraph.generated.groups.delta.delta_request_builder import (
+            DeltaRequestBuilder as GroupsDeltaRequestBuilder,
+        )
+
+        query_params = GroupsDeltaRequestBuilder.DeltaRequestBuilderGetQueryParameters(
+            select=["id", "displayName", "members"],
+        )
+        request_configuration = RequestConfiguration(
+            query_parameters=query_params,
+        )
+
+        def parse(group):
+            additional_data = group.additional_data or {}
+            # Membership changed, so the cached members are stale
+            if "@removed" in additional_data or "members@delta" in additional_data:
+                self.group_member_cache.invalidate(group.id)
+            if "@removed" in additional_data:
+                return None
+            return {"display_name": group.display_name}
+
+        def on_full_sync():
+            # A full sync does not report membership changes made while there
+            # was no valid delta token, so no cached member list can be trusted
+            logger.debug("Full group sync, clearing the group member cache")
+            self.group_member_cache.clear()
+
+        return await self._sync_delta(
+            "groups",
+            self.graph_client.groups.delta,
+            request_configuration,
+            parse,
+            on_full_sync=on_full_sync,
+        )
+
+    async def get_user_display_names(self):
+        await self.sync_users()
+        return self.directory_snapshot.get_display_names("users")
+
+    async def get_group_display_names(self):
+        await self.sync_groups()
+        return self.directory_snapshot.get_display_names("groups")
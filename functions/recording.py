@@ -0,0 +1,272 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import uuid
+from urllib.parse import urlsplit
+
+# Placeholders stand in for the real hosts, the replay server swaps in its own
+# address when the exchanges are loaded
+DEFAULT_HOSTS = {
+    "https://graph.microsoft.com": "{graph}",
+    "https://management.azure.com": "{arm}",
+}
+# Headers needed to replay an exchange, all others (Authorization, cookies,
+# request and correlation IDs) are dropped
+KEPT_HEADERS = {
+    "content-type",
+    "retry-after",
+    "retry-after-ms",
+    "x-ms-retry-after-ms",
+    "consistencylevel",
+    "location",
+}
+# JSON fields whose values are never written to a recording
+SECRET_FIELDS = {"access_token", "refresh_token", "client_secret", "password"}
+REDACTED = "REDACTED"
+# Directory fields replaced by pseudonyms unless the recording is kept raw
+NAME_FIELDS = {
+    "displayName",
+    "givenName",
+    "surname",
+    "mailNickname",
+    "principalName",
+    "username",
+}
+ADDRESS_FIELDS = {"userPrincipalName", "mail", "email", "otherMails"}
+GUID = re.compile(
+    r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.IGNORECASE
+)
+# Objects named after roles, scopes and subscriptions keep their names, the
+# jobs filter on them and they do not identify anyone
+NON_PRINCIPAL_KEYS = {"roleDefinition", "scope", "directoryScope", "appScope"}
+NON_PRINCIPAL_FIELDS = {"rolePermissions", "isBuiltIn", "subscriptionId", "roleName"}
+# Shorter names are too likely to match unrelated text in the final pass
+MIN_TEXT_NAME_LENGTH = 3
+
+
+def decode_body(body):
+    if body is None:
+        return None
+    if isinstance(body, (dict, list)):
+        return body
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="replace")
+    if not body:
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return body
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if key in SECRET_FIELDS else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+class Pseudonymizer:
+    # Replaces GUIDs, names and addresses by stable pseudonyms. The salt is
+    # random per recording, so a value maps to the same pseudonym within the
+    # recording and requests still match their responses on replay.
+    def __init__(self, salt=None):
+        self.salt = salt or os.urandom(16)
+        self.names = {}
+        self.lock = threading.Lock()
+
+    def token(self, value):
+        return hashlib.sha256(self.salt + value.encode("utf-8")).hexdigest()
+
+    def guid(self, value):
+        return str(uuid.UUID(self.token(value.lower())[:32]))
+
+    def name(self, value):
+        pseudonym = f"Name {self.token(value)[:10]}"
+        self._learn(value, pseudonym)
+        return pseudonym
+
+    def address(self, value):
+        pseudonym = f"user-{self.token(value.lower())[:10]}@example.invalid"
+        self._learn(value, pseudonym)
+        return pseudonym
+
+    def _learn(self, value, pseudonym):
+        if len(value) >= MIN_TEXT_NAME_LENGTH:
+            with self.lock:
+                self.names[value] = pseudonym
+
+    def text(self, text):
+        return GUID.sub(lambda match: self.guid(match.group(0)), text)
+
+    def value(self, value, key=None, names=True):
+        if isinstance(value, dict):
+            names = key not in NON_PRINCIPAL_KEYS and not (
+                NON_PRINCIPAL_FIELDS & value.keys()
+            )
+            return {name: self.value(item, name, names) for name, item in value.items()}
+        if isinstance(value, list):
+            return [self.value(item, key, names) for item in value]
+        if not isinstance(value, str) or not value:
+            return value
+        if names and key in NAME_FIELDS:
+            return self.name(value)
+        if key in ADDRESS_FIELDS:
+            return self.address(value)
+        return self.text(value)
+
+    def finish(self, lines):
+        # Names learned from the directory also occur in free text, such as
+        # Confluence page bodies, possibly recorded before the directory
+        names = sorted(self.names, key=len, reverse=True)
+        if not names:
+            yield from lines
+            return
+        pattern = re.compile(
+            r"(?<!\w)(?:%s)(?!\w)" % "|".join(re.escape(name) for name in names)
+        )
+
+        def replace(value):
+            if isinstance(value, str):
+                return pattern.sub(lambda match: self.names[match.group(0)], value)
+            if isinstance(value, dict):
+                return {key: replace(item) for key, item in value.items()}
+            if isinstance(value, list):
+                return [replace(item) for item in value]
+            return value
+
+        for line in lines:
+            exchange = replace(json.loads(line))
+            yield json.dumps(exchange, ensure_ascii=False) + "\n"
+
+
+class Recorder:
+    # Appends scrubbed request/response pairs as JSON lines, Graph $batch
+    # calls are stored as their sub-requests so the replay server can answer
+    # batches of any composition. Names, addresses and IDs are pseudonymized
+    # unless pseudonymize is False.
+    def __init__(self, directory, hosts=None, pseudonymize=True):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "exchanges.jsonl")
+        self.hosts = dict(DEFAULT_HOSTS, **(hosts or {}))
+        self.pseudonymizer = Pseudonymizer() if pseudonymize else None
+        self.lock = threading.Lock()
+        # Pseudonymized runs are written to a scratch file first, the final
+        # pass over free text needs every name of the run
+        self.output_path = self.path + ".partial" if pseudonymize else self.path
+        self.file = open(self.output_path, "a")
+
+    def add_host(self, url, placeholder):
+        self.hosts[url.rstrip("/")] = placeholder
+
+    def scrub_text(self, text):
+        # Longest URL first, so a Confluence context path wins over its host
+        for url in sorted(self.hosts, key=len, reverse=True):
+            text = text.replace(url, self.hosts[url])
+        return text
+
+    def scrub(self, value):
+        if self.pseudonymizer:
+            value = self.pseudonymizer.value(value)
+        return self._scrub_hosts(value)
+
+    def _scrub_hosts(self, value):
+        if isinstance(value, str):
+            return self.scrub_text(value)
+        if isinstance(value, dict):
+            return {key: self._scrub_hosts(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._scrub_hosts(item) for item in value]
+        return value
+
+    def record(
+        self,
+        method,
+        url,
+        request_body,
+        status,
+        response_headers,
+        response_body,
+        request_headers=None,
+    ):
+        url = str(url)
+        request_body = decode_body(request_body)
+        response_body = decode_body(response_body)
+        if (
+            urlsplit(url).path.endswith("/$batch")
+            and isinstance(request_body, dict)
+            and isinstance(response_body, dict)
+        ):
+            self._record_batch(url.rsplit("/$batch", 1)[0], request_body, response_body)
+            return
+        self._write(
+            method,
+            url,
+            request_headers,
+            request_body,
+            status,
+            response_headers,
+            response_body,
+        )
+
+    def _record_batch(self, base_url, request_body, response_body):
+        requests = {request["id"]: request for request in request_body["requests"]}
+        for response in response_body.get("responses", []):
+            request = requests.get(response.get("id"), {})
+            self._write(
+                request.get("method", "GET"),
+                base_url + request.get("url", ""),
+                request.get("headers"),
+                request.get("body"),
+                response.get("status"),
+                response.get("headers"),
+                response.get("body"),
+            )
+
+    def _write(
+        self,
+        method,
+        url,
+        request_headers,
+        request_body,
+        status,
+        response_headers,
+        response_body,
+    ):
+        exchange = {
+            "method": method,
+            "url": self.scrub(url),
+            "request": {
+                "headers": self.keep_headers(request_headers),
+                "body": self.scrub(redact(request_body)),
+            },
+            "status": status,
+            "headers": self.keep_headers(response_headers),
+            "body": self.scrub(redact(response_body)),
+        }
+        line = json.dumps(exchange, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def keep_headers(self, headers):
+        return {
+            key.lower(): value
+            for key, value in dict(headers or {}).items()
+            if key.lower() in KEPT_HEADERS
+        }
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            if not self.pseudonymizer:
+                return
+            with open(self.output_path) as partial, open(self.path, "a") as output:
+                output.writelines(self.pseudonymizer.finish(partial))
+            os.remove(self.output_path)
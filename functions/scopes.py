@@ -0,0 +1,88 @@
+import re
+from kestra import Kestra
+
+logger = Kestra.logger()
+
+SUBSCRIPTION_SCOPE_PATTERN = re.compile(
+    r"(^\/subscriptions\/)([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(.*)"
+)
+
+
+def build_substring_pattern(needles):
+    # One alternation instead of a scan per rule, longest rules first
+    needles = sorted(set(needles), key=len, reverse=True)
+    if not needles:
+        return None
+    return re.compile("|".join(re.escape(needle) for needle in needles))
+
+
+class ScopeResolver:
+    def __init__(
+        self,
+        subscription_dict=None,
+        subscription_id_exclusions=[],
+        subscription_exclusions=[],
+        role_exclusions=[],
+    ):
+        self.subscription_dict = subscription_dict or {}
+        self.subscription_id_exclusions = set(subscription_id_exclusions)
+        self.subscription_exclusion_pattern = build_substring_pattern(
+            subscription_exclusions
+        )
+        self.role_exclusion_pattern = build_substring_pattern(role_exclusions)
+        # Many rows share a scope or role, so every answer is memoized
+        self.translated_scopes = {}
+        self.described_scopes = {}
+        self.allowed_roles = {}
+
+    def translate(self, scope):
+        if scope not in self.translated_scopes:
+            self.translated_scopes[scope] = self._translate(scope)
+        return self.translated_scopes[scope]
+
+    def _translate(self, scope):
+        match = SUBSCRIPTION_SCOPE_PATTERN.match(scope)
+        if not match:
+            return scope
+        start, subscription_id, end = match.groups()
+
+        if subscription_id in self.subscription_dict:
+            subscription = self.subscription_dict[subscription_id]
+            logger.debug(f"Subscription found in Azure: {subscription}")
+        else:
+            logger.error("Subscription not found in Azure")
+            subscription = subscription_id
+        if subscription_id in self.subscription_id_exclusions:
+            return False
+        exclusion_pattern = self.subscription_exclusion_pattern
+        if exclusion_pattern and exclusion_pattern.search(subscription.lower()):
+            return False
+
+        scope = f"{start}{subscription}{end}"
+        logger.debug("Scope: " + scope)
+        return scope
+
+    def check_role(self, role):
+        if role not in self.allowed_roles:
+            self.allowed_roles[role] = not (
+                self.role_exclusion_pattern and self.role_exclusion_pattern.search(role)
+            )
+        return self.allowed_roles[role]
+
+    def describe(self, scope):
+        # Mirror the display name and type ARM puts into expandedProperties.scope
+        if scope not in self.described_scopes:
+            parts = scope.strip("/").split("/")
+            if len(parts) == 2 and parts[0].lower() == "subscriptions":
+                description = (
+                    self.subscription_dict.get(parts[1], parts[1]),
+                    "subscription",
+                )
+            elif len(parts) == 4 and parts[2].lower() == "resourcegroups":
+                description = (parts[3], "resourcegroup")
+            elif "managementgroups" in scope.lower():
+                description = (parts[-1], "managementgroup")
+            else:
+                description = (parts[-1], "resource")
+            self.described_scopes[scope] = description
+        return self.described_scopes[scope]
@@ -0,0 +1,150 @@
+import sqlite3
+from datetime import date
+from kestra import Kestra
+
+logger = Kestra.logger()
+
+# One snapshot per dataset and day, re-running on the same day replaces it
+DATASETS = ["entraid_eligible", "entraid_active", "azure_eligible", "azure_active"]
+
+
+class SnapshotStore:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS strings (
+                id INTEGER PRIMARY KEY, value TEXT UNIQUE NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS runs (
+                run_date TEXT, dataset TEXT, row_count INTEGER,
+                PRIMARY KEY (dataset, run_date)
+            );
+            CREATE TABLE IF NOT EXISTS assignments (
+                run_date TEXT, dataset TEXT,
+                user_id INTEGER, role_id INTEGER, scope_id INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS assignments_by_user
+                ON assignments (user_id, dataset, run_date);
+            CREATE INDEX IF NOT EXISTS assignments_by_role
+                ON assignments (role_id, dataset, run_date);
+            CREATE INDEX IF NOT EXISTS assignments_by_scope
+                ON assignments (scope_id, dataset, run_date);
+            CREATE INDEX IF NOT EXISTS assignments_by_run
+                ON assignments (dataset, run_date);
+            CREATE VIEW IF NOT EXISTS assignment_rows AS
+                SELECT a.run_date, a.dataset, u.value AS user, r.value AS role,
+                       s.value AS scope
+                FROM assignments a
+                JOIN strings u ON u.id = a.user_id
+                JOIN strings r ON r.id = a.role_id
+                LEFT JOIN strings s ON s.id = a.scope_id;
+            """)
+        self.string_ids = {}
+
+    def _string_id(self, value):
+        # Names repeat on almost every row, so they are stored once
+        if value is None:
+            return None
+        if value not in self.string_ids:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO strings (value) VALUES (?)", (value,)
+            )
+            self.string_ids[value] = self.connection.execute(
+                "SELECT id FROM strings WHERE value = ?", (value,)
+            ).fetchone()[0]
+        return self.string_ids[value]
+
+    def store(self, dataset, mappings, run_date=None):
+        run_date = run_date or date.today().isoformat()
+        rows = {
+            (
+                self._string_id(mapping["Benutzer"]),
+                self._string_id(mapping["Rolle"]),
+                self._string_id(mapping.get("Scope")),
+            )
+            for mapping in mappings
+        }
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM assignments WHERE dataset = ? AND run_date = ?",
+                (dataset, run_date),
+            )
+            self.connection.executemany(
+                "INSERT INTO assignments VALUES (?, ?, ?, ?, ?)",
+                ((run_date, dataset, *row) for row in rows),
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?)",
+                (run_date, dataset, len(rows)),
+            )
+        logger.info(f"Stored {len(rows)} {dataset} assignments for {run_date}")
+
+    def runs(self, dataset=None):
+        query = "SELECT run_date, dataset, row_count FROM runs"
+        parameters = ()
+        if dataset:
+            query += " WHERE dataset = ?"
+            parameters = (dataset,)
+        return self.connection.execute(
+            query + " ORDER BY run_date, dataset", parameters
+        ).fetchall()
+
+    def snapshot_date(self, dataset, on_date):
+        # Latest snapshot taken on or before the given day
+        row = self.connection.execute(
+            "SELECT MAX(run_date) FROM runs WHERE dataset = ? AND run_date <= ?",
+            (dataset, on_date),
+        ).fetchone()
+        return row[0]
+
+    def diff(self, dataset, from_date, to_date):
+        from_date = self.snapshot_date(dataset, from_date)
+        to_date = self.snapshot_date(dataset, to_date)
+        query = """
+            SELECT user, role, scope FROM assignment_rows
+            WHERE dataset = ? AND run_date = ?
+            EXCEPT
+            SELECT user, role, scope FROM assignment_rows
+            WHERE dataset = ? AND run_date = ?
+            ORDER BY 1, 2, 3
+        """
+        added = self.connection.execute(
+            query, (dataset, to_date, dataset, from_date)
+        ).fetchall()
+        removed = self.connection.execute(
+            query, (dataset, from_date, dataset, to_date)
+        ).fetchall()
+        return added, removed
+
+    def who_had(self, on_date, role=None, user=None, scope=None, datasets=DATASETS):
+        results = []
+        for dataset in datasets:
+            run_date = self.snapshot_date(dataset, on_date)
+            if not run_date:
+                continue
+            query = (
+                "SELECT dataset, run_date, user, role, scope FROM assignment_rows "
+                "WHERE dataset = ? AND run_date = ?"
+            )
+            parameters = [dataset, run_date]
+            for column, value in (("role", role), ("scope", scope), ("user", user)):
+                if value:
+                    query += f" AND {column} = ?"
+                    parameters.append(value)
+            results.extend(
+                self.connection.execute(query + " ORDER BY user", parameters)
+            )
+        return results
+
+    def close(self):
+        self.connection.close()
+
+
+def store_snapshot(path=None, dataset=None, mappings=None):
+    if not path:
+        return
+    snapshot_store = SnapshotStore(path)
+    try:
+        snapshot_store.store(dataset, mappings)
+    finally:
+        snapshot_store.close()
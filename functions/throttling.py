@@ -0,0 +1,213 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from kestra import Kestra
+from functions.instrumentation import instrumentation
+
+logger = Kestra.logger()
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Requests per second and burst size per endpoint family, roughly matching
+# the documented Graph, ARM and Resource Graph quotas for one app
+DEFAULT_RATE_LIMITS = {
+    "graph": (100, 200),
+    "arm": (20, 250),
+    "resourcegraph": (3, 15),
+}
+
+
+def get_status_and_headers(error):
+    # Covers kiota APIError, azure-core HttpResponseError and httpx errors
+    status = getattr(error, "response_status_code", None) or getattr(
+        error, "status_code", None
+    )
+    headers = getattr(error, "response_headers", None)
+    response = getattr(error, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    if headers is None and response is not None:
+        headers = getattr(response, "headers", None)
+    return status, headers or {}
+
+
+def parse_retry_after(headers):
+    for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+        value = headers.get(name)
+        if value:
+            return float(next(iter(value)) if isinstance(value, set) else value) / 1000
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if not value:
+        return None
+    if isinstance(value, set):
+        value = next(iter(value))
+    try:
+        return float(value)
+    except ValueError:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        # Take a token and return how long the caller has to wait for it
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class AdaptiveLimiter:
+    # Additive increase, multiplicative decrease of the allowed concurrency
+    def __init__(self, max_limit=32, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.async_condition = None
+
+    def _has_capacity(self):
+        return self.in_flight < max(self.min_limit, int(self.limit))
+
+    def _on_success(self):
+        self.in_flight -= 1
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _on_throttle(self):
+        self.in_flight -= 1
+        self.limit = max(self.min_limit, self.limit / 2)
+        logger.debug(f"Concurrency limit reduced to {int(self.limit)}")
+
+    def acquire(self):
+        with self.condition:
+            self.condition.wait_for(self._has_capacity)
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            if throttled:
+                self._on_throttle()
+            else:
+                self._on_success()
+            self.condition.notify_all()
+
+    async def acquire_async(self):
+        if self.async_condition is None:
+            self.async_condition = asyncio.Condition()
+        async with self.async_condition:
+            await self.async_condition.wait_for(self._has_capacity)
+            self.in_flight += 1
+
+    async def release_async(self, throttled=False):
+        async with self.async_condition:
+            if throttled:
+                self._on_throttle()
+            else:
+                self._on_success()
+            self.async_condition.notify_all()
+
+
+class RequestScheduler:
+    def __init__(
+        self, rate_limits=DEFAULT_RATE_LIMITS, max_retries=5, base_delay=1, max_delay=60
+    ):
+        self.rate_limits = rate_limits
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.buckets = {}
+        self.limiters = {}
+        self.throttled = {}
+        self.lock = threading.Lock()
+
+    def _family(self, family):
+        with self.lock:
+            if family not in self.buckets:
+                rate, capacity = self.rate_limits.get(family, (10, 20))
+                self.buckets[family] = TokenBucket(rate, capacity)
+                self.limiters[family] = AdaptiveLimiter()
+                self.throttled[family] = 0
+            return self.buckets[family], self.limiters[family]
+
+    def _retry_delay(self, family, error, attempt):
+        # Returns the delay before the next attempt and whether the limiter
+        # has to back off, None once the error is final
+        status, headers = get_status_and_headers(error)
+        if status not in RETRYABLE_STATUS_CODES or attempt >= self.max_retries:
+            return None, False
+        if status == 429:
+            with self.lock:
+                self.throttled[family] += 1
+            Kestra.counter("Throttled Requests", 1, {"family": family})
+        delay = parse_retry_after(headers)
+        if delay is None:
+            # Full jitter exponential backoff
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        logger.warning(
+            f"{family} request failed with {status}, retrying in {delay:.1f}s"
+        )
+        # A server error must not raise the concurrency limit either
+        return delay, True
+
+    async def run(self, family, function, *args, **kwargs):
+        bucket, limiter = self._family(family)
+        attempt = 0
+        while True:
+            wait = bucket.reserve()
+            instrumentation.record_wait(family, wait)
+            await asyncio.sleep(wait)
+            await limiter.acquire_async()
+            try:
+                result = await function(*args, **kwargs)
+            except Exception as e:
+                delay, throttled = self._retry_delay(family, e, attempt)
+                await limiter.release_async(throttled=throttled)
+                if delay is None:
+                    raise
+                attempt += 1
+                instrumentation.record_wait(family, delay)
+                await asyncio.sleep(delay)
+                continue
+            await limiter.release_async()
+            return result
+
+    def run_sync(self, family, function, *args, **kwargs):
+        bucket, limiter = self._family(family)
+        attempt = 0
+        while True:
+            wait = bucket.reserve()
+            instrumentation.record_wait(family, wait)
+            time.sleep(wait)
+            limiter.acquire()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                delay, throttled = self._retry_delay(family, e, attempt)
+                limiter.release(throttled=throttled)
+                if delay is None:
+                    raise
+                attempt += 1
+                instrumentation.record_wait(family, delay)
+                time.sleep(delay)
+                continue
+            limiter.release()
+            return result
+
+
+# Shared by every Graph, ARM and Resource Graph call of a run
+scheduler = RequestScheduler()
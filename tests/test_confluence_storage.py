@@ -0,0 +1,40 @@
+from functions.confluence import convert_to_html_table, read_storage_table
+
+SIGNATURE = ("Benutzer", "Rolle")
+CODE_MACRO = (
+    '<ac:structured-macro ac:name="code"><ac:plain-text-body>'
+    "<![CDATA[if a < b && c > d:]]>"
+    "</ac:plain-text-body></ac:structured-macro>"
+)
+STORAGE = (
+    "<p>Achtung!&nbsp;Nur bestehende Einträge ergänzen</p>"
+    "<table><tbody>"
+    "<tr><th>Benutzer</th><th>Rolle</th><th>Notiz</th></tr>"
+    f"<tr><td>M&uuml;ller</td><td>Owner</td><td>{CODE_MACRO} siehe "
+    '<ri:user ri:userkey="1234"/></td></tr>'
+    "<tr><td>Meier</td><td>Reader</td><td></td></tr>"
+    "</tbody></table>"
+)
+
+
+def read(storage):
+    headers, rows = read_storage_table(
+        storage, signature=SIGNATURE, text_columns=SIGNATURE
+    )
+    return headers, list(rows)
+
+
+def test_cdata_macro_body_survives_round_trip():
+    headers, rows = read(STORAGE)
+    assert headers == ["Benutzer", "Rolle", "Notiz"]
+    assert rows[0]["Benutzer"] == "Müller"
+    assert rows[0]["Notiz"] == f'{CODE_MACRO} siehe <ri:user ri:userkey="1234"/>'
+
+    written = convert_to_html_table(data=rows, escape=True)
+    assert "<![CDATA[if a < b && c > d:]]>" in written
+    assert "xmlns" not in written
+    assert read(written) == (headers, rows)
+
+
+def test_blank_page_has_no_rows():
+    assert read("") == ([], [])